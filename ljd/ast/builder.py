@@ -2,11 +2,13 @@
 # Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
 #
 
+import array
+
 import ljd.ast.nodes as nodes
 import ljd.bytecode.instructions as ins
 import ljd
 from ljd.bytecode.constants import T_FALSE, T_NIL, T_TRUE
-from ljd.bytecode.helpers import get_jump_destination
+from ljd.bytecode.helpers import get_jump_destination, set_jump_destination
 
 handle_invalid_functions = False
 
@@ -17,6 +19,7 @@ class _State:
         self.block = None
         self.blocks = []
         self.block_starts = {}
+        self.inserted_blocks = {}
         self.header = None
 
     def _warp_in_block(self, addr):
@@ -133,14 +136,8 @@ _WARP_INSTRUCTIONS = None
 
 
 def _blockenize(state, instructions):
-    # Fix inverted comparison expressions (e.g. 0 < variable):
-    _fix_inverted_comparison_expressions(state, instructions)
-
-    # Fix "repeat until true" encapsulated by another loop
-    _fix_broken_repeat_until_loops(state, instructions)
-
-    # Fix "var_1 = var_1 [comparison] var_2 and (operation) var_1 or var_1" edge case
-    _fix_broken_unary_expressions(state, instructions)
+    # Fix the compiler quirks the rest of the builder can't handle
+    _apply_peephole_rules(state, instructions)
 
     addr = 1
 
@@ -195,11 +192,14 @@ def _blockenize(state, instructions):
 def _establish_warps(state, instructions):
     state.blocks[0].warpins_count = 1
 
-    enumerated_blocks = enumerate(state.blocks[:-1])
-    for i, block in enumerated_blocks:
-        if state.blocks.__contains__(block) is None:
-            continue
+    # Merged blocks are only dropped from state.blocks (and the blocks from
+    # _build_conditional_warp added to it) once all the warps are built
+    blocks = state.blocks
+    merged_blocks = set()
 
+    next_jumps = None
+
+    for i, block in enumerate(blocks[:-1]):
         state.block = block
 
         end_addr = block.last_address + 1
@@ -207,6 +207,7 @@ def _establish_warps(state, instructions):
 
         # Catch certain double unconditional jumps caused by logical primitives in expressions:
         if start_addr == (end_addr - 1) \
+                and block not in merged_blocks \
                 and end_addr + 1 < len(instructions) \
                 and instructions[start_addr].opcode == ins.JMP.opcode \
                 and instructions[end_addr].opcode == ins.JMP.opcode \
@@ -214,28 +215,24 @@ def _establish_warps(state, instructions):
                 and instructions[start_addr].CD == 0:
 
             end_instruction_destination = end_addr + instructions[end_addr].CD + 1
-            target_instruction_A = instructions[start_addr].A
-            exit_instruction_found = False
 
             # When two consecutive jumps are found with the same A operand, lookahead for the end jump.
-            following_destination = -1
-            for j in range(end_addr + 1, len(instructions) - 1):
-                following_instruction = instructions[j]
-                if following_instruction.opcode == ins.JMP.opcode:
-                    if following_instruction.A == target_instruction_A:
-                        following_destination = get_jump_destination(j, following_instruction)
-                        exit_instruction_found = True
-                        break
+            if next_jumps is None:
+                next_jumps = _find_next_jumps(instructions)
+
+            following_jump_addr = next_jumps[end_addr]
 
             # If we find the exit jump and we're not skipping it (if true then break else),
             #  form the original two jumps into a fake conditional warp.
-            if exit_instruction_found \
-                    and end_instruction_destination <= following_destination:
+            if following_jump_addr is not None \
+                    and following_jump_addr < len(instructions) - 1 \
+                    and end_instruction_destination <= get_jump_destination(
+                        following_jump_addr, instructions[following_jump_addr]):
                 fixed_instruction = ins.ISF()
                 fixed_instruction.CD = ins.SLOT_FALSE
 
                 instructions[start_addr] = fixed_instruction
-                state.blocks.pop(state.blocks.index(block) + 1)
+                merged_blocks.add(blocks[i + 1])
 
                 block.last_address += 1
                 start_addr = max(block.last_address - 1, block.first_address)
@@ -248,6 +245,15 @@ def _establish_warps(state, instructions):
         setattr(block, "_last_body_addr", block.last_address - shift)
         setattr(block.warp, "_addr", block.last_address - shift + 1)
 
+    if merged_blocks or state.inserted_blocks:
+        state.blocks = []
+
+        for block in blocks:
+            state.blocks += state.inserted_blocks.pop(block, [])
+
+            if block not in merged_blocks:
+                state.blocks.append(block)
+
     last_block = state.blocks[-1]
     last_block.warp = nodes.EndWarp()
 
@@ -255,6 +261,21 @@ def _establish_warps(state, instructions):
     setattr(last_block.warp, "_addr", last_block.last_address)
 
 
+# For every JMP, the address of the next JMP with the same A operand
+def _find_next_jumps(instructions):
+    next_jumps = [None] * len(instructions)
+    last_jumps = {}
+
+    for addr in range(len(instructions) - 1, -1, -1):
+        instruction = instructions[addr]
+
+        if instruction.opcode == ins.JMP.opcode:
+            next_jumps[addr] = last_jumps.get(instruction.A)
+            last_jumps[instruction.A] = addr
+
+    return next_jumps
+
+
 def _build_warp(state, last_addr, instructions):
     last = instructions[-1]
 
@@ -334,7 +355,7 @@ def _build_conditional_warp(state, last_addr, instructions):
         block.warp.target = warp.true_target
         setattr(block.warp, "_addr", block.last_address - shift + 1)
 
-        state.blocks.insert(state.blocks.index(warp.true_target), block)
+        state.inserted_blocks.setdefault(warp.true_target, []).append(block)
         warp.true_target = block
 
         _create_no_op(state, jump_addr, block)
@@ -357,6 +378,9 @@ def _build_unconditional_warp(state, addr, instruction):
 
     warp.is_uclo = opcode == ins.UCLO.opcode
 
+    if warp.is_uclo:
+        _add_uclo(state, addr, instruction)
+
     shift = 1
     if warp.is_uclo and instruction.CD == 0:
         # Not a jump
@@ -442,18 +466,31 @@ def _assignment_marked(func):
     return decorated
 
 
+# Set in init() - see it's comment
+_STATEMENT_BUILDERS = None
+_EXPRESSION_BUILDERS = None
+
+
 def _build_statement(state, addr, instruction):
-    opcode = instruction.opcode
-    A_type = instruction.A_type
+    builder = _STATEMENT_BUILDERS[instruction.opcode]
+    assert builder is not None
+
+    return builder(state, addr, instruction)
+
+
+# Picks the _STATEMENT_BUILDERS entry for an instruction, called from init()
+def _select_statement_builder(definition):
+    opcode = definition.opcode
+    A_type = definition.A_type
 
     # Generic assignments - handle the ASSIGNMENT stuff below
     if A_type == ins.T_DST or A_type == ins.T_UV:
-        return _build_var_assignment(state, addr, instruction)
+        return _build_var_assignment
 
     # ASSIGNMENT starting from MOV and ending at KPRI
 
     elif opcode == ins.KNIL.opcode:
-        return _build_knil(state, addr, instruction)
+        return _build_knil
 
     # ASSIGNMENT starting from UGET and ending at USETP
 
@@ -462,41 +499,83 @@ def _build_statement(state, addr, instruction):
     # ASSIGNMENT starting from FNEW and ending at GGET
 
     elif opcode == ins.GSET.opcode:
-        return _build_global_assignment(state, addr, instruction)
+        return _build_global_assignment
 
     # ASSIGNMENT starting from TGETV and ending at TGETR
 
     elif opcode >= ins.TSETV.opcode and (opcode <= ins.TSETB.opcode
                                          or (ljd.CURRENT_VERSION > 2.0
                                              and opcode == ins.TSETR.opcode)):
-        return _build_table_assignment(state, addr, instruction)
+        return _build_table_assignment
 
     elif opcode == ins.TSETM.opcode:
-        return _build_table_mass_assignment(state, addr, instruction)
+        return _build_table_mass_assignment
 
     elif ins.CALLM.opcode <= opcode <= ins.CALLT.opcode:
-        return _build_call(state, addr, instruction)
+        return _build_call
 
     elif opcode == ins.VARG.opcode:
-        return _build_vararg(state, addr, instruction)
+        return _build_vararg
 
     elif ins.RETM.opcode <= opcode <= ins.RET1.opcode:
-        return _build_return(state, addr, instruction)
+        return _build_return
+
+    elif opcode == ins.UCLO.opcode or (
+            ins.LOOP.opcode <= opcode <= ins.JLOOP.opcode):
+        return _build_no_op_statement
 
     else:
-        assert opcode == ins.UCLO.opcode or (
-                ins.LOOP.opcode <= opcode <= ins.JLOOP.opcode)
-        # NoOp
-        # TODO get the line no. for the loop set up
-        return None, None
+        return None
+
+
+def _build_no_op_statement(state, addr, instruction):
+    if instruction.opcode == ins.UCLO.opcode:
+        _add_uclo(state, addr, instruction)
+
+    # NoOp
+    # TODO get the line no. for the loop set up
+    return None, None
+
+
+# Keeps the address of each UCLO in its block, along with the first slot it
+#  closes, for the goto output to tell where the locals captured by closures
+#  go out of scope. It can't be a statement, the unwarper has no use for it.
+def _add_uclo(state, addr, instruction):
+    uclos = getattr(state.block, "_uclos", None)
+
+    if uclos is None:
+        uclos = []
+        setattr(state.block, "_uclos", uclos)
+
+    uclos.append((addr, instruction.A))
 
 
 @_assignment_marked
 def _build_var_assignment(state, addr, instruction):
-    opcode = instruction.opcode
-
     assignment = nodes.Assignment()
 
+    builder = _EXPRESSION_BUILDERS[instruction.opcode]
+    assert builder is not None
+
+    expression = builder(state, addr, instruction)
+
+    assignment.expressions.contents.append(expression)
+
+    if instruction.A_type == ins.T_DST:
+        destination = _build_slot(state, addr, instruction.A)
+    else:
+        assert instruction.A_type == ins.T_UV
+
+        destination = _build_upvalue(state, addr, instruction.A)
+
+    assignment.destinations.contents.append(destination)
+
+    return assignment
+
+
+# Picks the _EXPRESSION_BUILDERS entry for the right side of a
+# _build_var_assignment, called from init()
+def _select_expression_builder(opcode):
     # Unary assignment operators (A = op D)
     if opcode == ins.MOV.opcode \
             or opcode == ins.NOT.opcode \
@@ -504,61 +583,73 @@ def _build_var_assignment(state, addr, instruction):
             or (ljd.CURRENT_VERSION > 2.0 and opcode == ins.ISTYPE.opcode) \
             or (ljd.CURRENT_VERSION > 2.0 and opcode == ins.ISNUM.opcode) \
             or opcode == ins.LEN.opcode:
-        expression = _build_unary_expression(state, addr, instruction)
+        return _build_unary_expression
 
     # Binary assignment operators (A = B op C)
     elif opcode <= ins.POW.opcode:
-        expression = _build_binary_expression(state, addr, instruction)
+        return _build_binary_expression
 
     # Concat assignment type (A = B .. B + 1 .. ... .. C - 1 .. C)
     elif opcode == ins.CAT.opcode:
-        expression = _build_concat_expression(state, addr, instruction)
+        return _build_concat_expression
 
     # Constant assignment operators except KNIL, which is weird anyway
     elif opcode <= ins.KPRI.opcode:
-        expression = _build_const_expression(state, addr, instruction)
+        return _build_const_expression
 
     elif opcode == ins.UGET.opcode:
-        expression = _build_upvalue(state, addr, instruction.CD)
+        return _build_upvalue_expression
 
     elif opcode == ins.USETV.opcode:
-        expression = _build_slot(state, addr, instruction.CD)
+        return _build_slot_expression
 
     elif opcode <= ins.USETP.opcode:
-        expression = _build_const_expression(state, addr, instruction)
+        return _build_const_expression
 
     elif opcode == ins.FNEW.opcode:
-        expression = _build_function(state, instruction.CD)
+        return _build_function_expression
 
     elif opcode == ins.TNEW.opcode:
-        expression = nodes.TableConstructor()
+        return _build_table_constructor_expression
 
     elif opcode == ins.TDUP.opcode:
-        expression = _build_table_copy(state, instruction.CD)
+        return _build_table_copy_expression
 
     elif opcode == ins.GGET.opcode:
-        expression = _build_global_variable(state, addr, instruction.CD)
+        return _build_global_variable_expression
 
-    else:
-        if ljd.CURRENT_VERSION > 2.0:
-            assert opcode <= ins.TGETR.opcode
-            expression = _build_table_element(state, addr, instruction)
-        else:
-            assert opcode <= ins.TGETB.opcode
-            expression = _build_table_element(state, addr, instruction)
+    elif ljd.CURRENT_VERSION > 2.0 and opcode <= ins.TGETR.opcode:
+        return _build_table_element
 
-    assignment.expressions.contents.append(expression)
+    elif ljd.CURRENT_VERSION <= 2.0 and opcode <= ins.TGETB.opcode:
+        return _build_table_element
 
-    if instruction.A_type == ins.T_DST:
-        destination = _build_slot(state, addr, instruction.A)
     else:
-        assert instruction.A_type == ins.T_UV
+        return None
 
-        destination = _build_upvalue(state, addr, instruction.A)
 
-    assignment.destinations.contents.append(destination)
+def _build_upvalue_expression(state, addr, instruction):
+    return _build_upvalue(state, addr, instruction.CD)
+
+
+def _build_slot_expression(state, addr, instruction):
+    return _build_slot(state, addr, instruction.CD)
+
+
+def _build_function_expression(state, addr, instruction):
+    return _build_function(state, instruction.CD)
 
-    return assignment
+
+def _build_table_constructor_expression(state, addr, instruction):
+    return nodes.TableConstructor()
+
+
+def _build_table_copy_expression(state, addr, instruction):
+    return _build_table_copy(state, instruction.CD)
+
+
+def _build_global_variable_expression(state, addr, instruction):
+    return _build_global_variable(state, addr, instruction.CD)
 
 
 @_assignment_marked
@@ -867,16 +958,20 @@ def _build_table_copy(state, slot):
 
     table = state.constants.complex_constants[slot]
 
-    i = 0
+    # Data modules can have huge templates, so the records are only built if
+    # a pass actually needs them
+    node.build_lazily(table, _build_table_copy_records)
+
+    return node
 
+
+def _build_table_copy_records(node, table):
     for value in table.array:
         record = nodes.ArrayRecord()
         record.value = _build_table_record_item(value)
 
         node.array.contents.append(record)
 
-        i += 1
-
     for key, value in table.dictionary:
         record = nodes.TableRecord()
         record.key = _build_table_record_item(key)
@@ -884,8 +979,6 @@ def _build_table_copy(state, slot):
 
         node.records.contents.append(record)
 
-    return node
-
 
 def _build_table_record_item(value):
     item = None
@@ -1060,258 +1153,348 @@ def _build_literal(state, value):
     return node
 
 
-def _fix_inverted_comparison_expressions(state, instructions):
+# Peephole rules, each one is registered for the instructions it starts
+# matching on. init() turns these into _PEEPHOLE_RULES, indexed by opcode.
+_PEEPHOLE_RULE_DEFINITIONS = []
+
+# Set in init()
+_PEEPHOLE_RULES = None
+
+
+def _peephole_rule(*definitions):
+    def decorator(func):
+        _PEEPHOLE_RULE_DEFINITIONS.append((definitions, func))
+        return func
+
+    return decorator
+
+
+# Runs all the peephole rules in a single scan over the instructions.
+#
+# A rule is called with the index of an instruction of one of its types. It
+# may change instructions in place, but insertions and removals are only
+# recorded in the function's _InstructionEdits and applied once the scan is
+# done. So the scan never moves an instruction, every index a rule works with
+# (including the ones it records edits at) is an index from before any edits,
+# and the neighbours a rule looks at are the original ones.
+def _apply_peephole_rules(state, instructions):
+    edits = _InstructionEdits(state, instructions)
+
     for i, instruction in enumerate(instructions):
+        for rule in _PEEPHOLE_RULES[instruction.opcode]:
+            rule(instructions, edits, i)
+
+    edits.apply()
+
 
-        if ins.ISLT.opcode <= instruction.opcode <= ins.ISGT.opcode:
-            left_slot = instruction.A
-            right_slot = instruction.CD
+# Fix inverted comparison expressions (e.g. 0 < variable)
+@_peephole_rule(ins.ISLT, ins.ISGE, ins.ISLE, ins.ISGT)
+def _fix_inverted_comparison_expression(instructions, edits, i):
+    instruction = instructions[i]
 
-            is_inverted = False
-            if i > 0:
-                preceding_instruction = instructions[i - 1]
+    left_slot = instruction.A
+    right_slot = instruction.CD
+
+    is_inverted = False
+    if i > 0:
+        preceding_instruction = instructions[i - 1]
+
+        # Matching A slot for left slot
+        if hasattr(preceding_instruction, "A") and preceding_instruction.A == left_slot:
+            opcode = preceding_instruction.opcode
+
+            # Previous instruction is likely a number assignment to left slot
+            if ins.UNM.opcode <= opcode <= ins.POW.opcode \
+                    or ins.KSHORT.opcode <= opcode <= ins.KNUM.opcode:
+                is_inverted = True
+
+    # Invert order of slots
+    if is_inverted:
+        instruction.A = right_slot
+        instruction.CD = left_slot
+
+        if instruction.opcode == ins.ISGT.opcode:
+            instruction.opcode = ins.ISLT.opcode
+        elif instruction.opcode == ins.ISGE.opcode:
+            instruction.opcode = ins.ISLE.opcode
+
+        elif instruction.opcode == ins.ISLT.opcode:
+            instruction.opcode = ins.ISGT.opcode
+        elif instruction.opcode == ins.ISLE.opcode:
+            instruction.opcode = ins.ISGE.opcode
+
+
+# Fix "repeat until true" encapsulated by another loop
+@_peephole_rule(ins.LOOP)
+def _fix_broken_repeat_until_loop(instructions, edits, i):
+    instruction = instructions[i]
+
+    # Check for the conditional jump that restarts the loop
+    loop_exit_addr = get_jump_destination(i, instruction)
+    loop_condition_addr = loop_exit_addr - 1
+    loop_condition_instruction = instructions[loop_condition_addr]
+    if not loop_condition_instruction.opcode == ins.JMP.opcode:
+        if get_jump_destination(loop_condition_addr, loop_condition_instruction) <= i:
+            return
+
+        # It's not there, so this is probably a repeat-until true loop.
+
+        # We need a fake conditional warp that is treated as 'true' by the writer
+        fixed_cond_instruction = ins.ISF()
+        fixed_cond_instruction.CD = ins.SLOT_TRUE
+
+        # Add fake conditional instructions
+        insertion_index = loop_condition_addr + 1
+
+        # Resulting jump to the loop starting point
+        fixed_jump_instruction = ins.JMP()
+        set_jump_destination(insertion_index, fixed_jump_instruction, i)
+
+        edits.insert(insertion_index, fixed_cond_instruction)
+        edits.insert(insertion_index, fixed_jump_instruction)
+
+        # Fix non-break destinations within the loop
+        # Breaks in the empty-condition loop point towards the same exit destination
+        # as non-breaks, so we'll have to search for a pattern of jumps.
+        # The non-breaks are moved onto the fake condition, the breaks keep
+        # jumping past it.
+
+        leading_jump = False
+        start_index = i + 1
+        for j in range(start_index, insertion_index):
+            checked_instruction = instructions[j]
+
+            # Look for following JMP instructions
+            if checked_instruction.opcode == ins.JMP.opcode:
+
+                # Leading jump indicates this is a break?
+                if not leading_jump:
+                    checked_instruction_destination \
+                        = get_jump_destination(j, checked_instruction)
+
+                    # If the jump goes to the loop exit
+                    if checked_instruction_destination == insertion_index:
+
+                        # Check for an inverted jump pair
+                        next_index = j + 1
+                        following_instruction = instructions[next_index]
+                        if following_instruction.opcode == ins.JMP.opcode:
+                            following_destination \
+                                = get_jump_destination(next_index, following_instruction)
+
+                            # e.g. goto 277 followed directly by goto 176
+                            if following_destination < checked_instruction_destination:
+                                leading_jump = True
+                                continue
+
+                            # e.g. goto 277 followed directly by goto 277
+                            elif following_destination == checked_instruction_destination:
+                                leading_jump = False
+                                continue
+
+                        # Check for else-break-end following this jump
+                        following_else_break_found = False
+                        prev_jump = False
+                        for k in range(next_index, insertion_index):
+                            following_instruction = instructions[k]
+                            if following_instruction.opcode == ins.JMP.opcode:
+                                if not prev_jump:
+                                    prev_jump = True
+
+                                else:
+                                    following_destination \
+                                        = get_jump_destination(k, following_instruction)
+
+                                    # Don't adjust the checked jump, it's probably a break
+                                    if following_destination == checked_instruction_destination:
+                                        following_else_break_found = True
+                                        break
+
+                                    prev_jump = False
+
+                            else:
+                                if prev_jump:
+                                    last_destination \
+                                        = get_jump_destination(k - 1, instructions[k - 1])
+                                    # We can adjust, it's probably not a break
+                                    if last_destination < checked_instruction_destination:
+                                        break
+                                prev_jump = False
 
-                # Matching A slot for left slot
-                if hasattr(preceding_instruction, "A") and preceding_instruction.A == left_slot:
-                    opcode = preceding_instruction.opcode
+                        if not following_else_break_found:
+                            edits.land_on_inserts(j)
+                leading_jump = True
 
-                    # Previous instruction is likely a number assignment to left slot
-                    if ins.UNM.opcode <= opcode <= ins.POW.opcode \
-                            or ins.KSHORT.opcode <= opcode <= ins.KNUM.opcode:
-                        is_inverted = True
+            else:
+                leading_jump = False
 
-            # Invert order of slots
-            if is_inverted:
-                instruction.A = right_slot
-                instruction.CD = left_slot
 
-                if instruction.opcode == ins.ISGT.opcode:
-                    instruction.opcode = ins.ISLT.opcode
-                elif instruction.opcode == ins.ISGE.opcode:
-                    instruction.opcode = ins.ISLE.opcode
+# Fix "var_1 = var_1 [comparison] var_2 and (operation) var_1 or var_1" edge case
+@_peephole_rule(ins.ISTC)
+def _fix_broken_unary_expression(instructions, edits, i):
+    instruction = instructions[i]
 
-                elif instruction.opcode == ins.ISLT.opcode:
-                    instruction.opcode = ins.ISGT.opcode
-                elif instruction.opcode == ins.ISLE.opcode:
-                    instruction.opcode = ins.ISGE.opcode
+    if i > 2 and ins.ADDVN.opcode <= instructions[i - 1].opcode <= ins.CAT.opcode:
 
+        # Search for a jump that precedes the ISTC op
+        leading_jump_found = False
+        for j in range(1, i):
+            if instructions[i - j].opcode == ins.JMP.opcode:
+                leading_jump_found = True
+                break
+            elif instructions[i - j].opcode not in range(ins.ADDVN.opcode, ins.CAT.opcode):
+                break
 
-def _fix_broken_repeat_until_loops(state, instructions):
-    enumerated_instructions = enumerate(instructions)
-    for i, instruction in enumerated_instructions:
+        # Make sure the preceding jump matches the destination of the ISTC op
+        instruction_destination = get_jump_destination(i + 1, instructions[i + 1])
+        if instruction_destination == i + 2 and leading_jump_found:
+            # Additional jump edge case of an edge case when expression is in an else body
+            if not instruction_destination == get_jump_destination(i - j, instructions[i - j]):
 
-        if instruction.opcode == ins.LOOP.opcode:
+                if instructions[i + 2].opcode == ins.JMP.opcode:
+                    instruction_destination = get_jump_destination(i + 2, instructions[i + 2])
 
-            # Check for the conditional jump that restarts the loop
-            loop_exit_addr = get_jump_destination(i, instruction)
-            loop_condition_addr = loop_exit_addr - 1
-            loop_condition_instruction = instructions[loop_condition_addr]
-            if not loop_condition_instruction.opcode == ins.JMP.opcode:
-                if get_jump_destination(loop_condition_addr, loop_condition_instruction) <= i:
-                    continue
+                    if instruction_destination == get_jump_destination(i - j, instructions[i - j]):
+                        instructions[i - 1].A = instruction.A
 
-                # It's not there, so this is probably a repeat-until true loop.
+                        # Remove the broken condition
+                        edits.remove(i)
+                        edits.remove(i + 1)
 
-                # We need a fake conditional warp that is treated as 'true' by the writer
-                fixed_cond_instruction = ins.ISF()
-                fixed_cond_instruction.CD = ins.SLOT_TRUE
+            else:
+                instructions[i - 1].A = instruction.A
 
-                # Resulting jump to the loop starting point
-                fixed_jump_instruction = ins.JMP()
-                fixed_jump_instruction.CD = i - loop_condition_addr - 1
+                # Remove the broken condition
+                edits.remove(i)
+                edits.remove(i + 1)
 
-                # Add fake conditional instructions
-                insertion_index = loop_condition_addr + 1
-                _insert_instruction(state, instructions, insertion_index, fixed_jump_instruction)
-                _insert_instruction(state, instructions, insertion_index, fixed_cond_instruction)
 
-                shift = 2
+class _InstructionEdits:
+    # Collects instruction inserts and removals and applies them in one go,
+    # relocating the jumps, the line map and the variable ranges in a single
+    # pass. All indices are the ones from before any of the edits, that
+    # includes the destinations of inserted jumps, which are taken relative
+    # to the index they are inserted at.
+    #
+    # The relocation follows what applying the edits one by one would do:
+    #  * A forward jump to an insertion point lands on the original
+    #     instruction, a backward jump lands on the first inserted one.
+    #     land_on_inserts() makes a forward jump land on the inserted ones too.
+    #  * A forward jump to a removed instruction lands on the one after it,
+    #     a backward jump on the one before it.
 
-                # Fix non-break destinations within the loop
-                # Breaks in the empty-condition loop point towards the same exit destination
-                # as non-breaks, so we'll have to search for a pattern of jumps.
+    def __init__(self, state, instructions):
+        self.state = state
+        self.instructions = instructions
+        self.inserts = []
+        self.removals = set()
+        self.jumps_to_inserts = set()
 
-                leading_jump = False
-                start_index = i + 1
-                for j in range(start_index, insertion_index):
-                    checked_instruction = instructions[j]
-
-                    # Look for following JMP instructions
-                    if checked_instruction.opcode == ins.JMP.opcode:
-
-                        # Leading jump indicates this is a break?
-                        if not leading_jump:
-                            checked_instruction_destination \
-                                = get_jump_destination(j, checked_instruction)
-
-                            # If the destination would've been moved
-                            if checked_instruction.CD >= shift \
-                                    and checked_instruction_destination == insertion_index + shift:
-
-                                # Check for an inverted jump pair
-                                next_index = j + 1
-                                following_instruction = instructions[next_index]
-                                if following_instruction.opcode == ins.JMP.opcode:
-                                    following_destination \
-                                        = get_jump_destination(next_index, following_instruction)
+    def insert(self, index, instruction):
+        self.inserts.append((index, instruction))
 
-                                    # e.g. goto 277 followed directly by goto 176
-                                    if following_destination < checked_instruction_destination:
-                                        leading_jump = True
-                                        continue
+    def remove(self, index):
+        self.removals.add(index)
 
-                                    # e.g. goto 277 followed directly by goto 277
-                                    elif following_destination == checked_instruction_destination:
-                                        leading_jump = False
-                                        continue
+    def land_on_inserts(self, index):
+        self.jumps_to_inserts.add(index)
 
-                                # Check for else-break-end following this jump
-                                following_else_break_found = False
-                                prev_jump = False
-                                for k in range(next_index, insertion_index):
-                                    following_instruction = instructions[k]
-                                    if following_instruction.opcode == ins.JMP.opcode:
-                                        if not prev_jump:
-                                            prev_jump = True
-
-                                        else:
-                                            following_destination \
-                                                = get_jump_destination(k, following_instruction)
-
-                                            # Don't adjust the checked jump, it's probably a break
-                                            if following_instruction.CD >= shift \
-                                                    and following_destination \
-                                                    == checked_instruction_destination:
-                                                following_else_break_found = True
-                                                break
-
-                                            prev_jump = False
-
-                                    else:
-                                        if prev_jump:
-                                            last_destination \
-                                                = get_jump_destination(k - 1, instructions[k - 1])
-                                            # We can adjust, it's probably not a break
-                                            if last_destination < checked_instruction_destination:
-                                                break
-                                        prev_jump = False
-
-                                if not following_else_break_found:
-                                    checked_instruction.CD -= shift
-                        leading_jump = True
-
-                    else:
-                        leading_jump = False
-
-
-def _fix_broken_unary_expressions(state, instructions):
-    enumerated_instructions = enumerate(instructions)
-    for i, instruction in enumerated_instructions:
-        if i > 2 and instruction.opcode == ins.ISTC.opcode \
-                and ins.ADDVN.opcode <= instructions[i - 1].opcode <= ins.CAT.opcode:
-
-            # Search for a jump that precedes the ISTC op
-            leading_jump_found = False
-            for j in range(1, i):
-                if instructions[i - j].opcode == ins.JMP.opcode:
-                    leading_jump_found = True
-                    break
-                elif instructions[i - j].opcode not in range(ins.ADDVN.opcode, ins.CAT.opcode):
-                    break
-
-            # Make sure the preceding jump matches the destination of the ISTC op
-            instruction_destination = get_jump_destination(i + 1, instructions[i + 1])
-            if instruction_destination == i + 2 and leading_jump_found:
-                # Additional jump edge case of an edge case when expression is in an else body
-                if not instruction_destination == get_jump_destination(i - j, instructions[i - j]):
-
-                    if instructions[i + 2].opcode == ins.JMP.opcode:
-                        instruction_destination = get_jump_destination(i + 2, instructions[i + 2])
-
-                        if instruction_destination == get_jump_destination(i - j, instructions[i - j]):
-                            instructions[i - 1].A = instruction.A
-
-                            # Remove the broken condition
-                            _remove_instruction(state, instructions, i + 1)
-                            _remove_instruction(state, instructions, i)
-
-                else:
-                    instructions[i - 1].A = instruction.A
-
-                    # Remove the broken condition
-                    _remove_instruction(state, instructions, i + 1)
-                    _remove_instruction(state, instructions, i)
-
-
-def _insert_instruction(state, instructions, index, new_instruction):
-    preceding_index = index - 1
-    line_mapping = state.debuginfo.addr_to_line_map[preceding_index]
-
-    instructions.insert(index, new_instruction)
-    state.debuginfo.addr_to_line_map.insert(index, line_mapping)
-
-    # Offset
-    shift = 1
+    def apply(self):
+        if not self.inserts and not self.removals:
+            return
+
+        instructions = self.instructions
+        line_map = self.state.debuginfo.addr_to_line_map
+        has_lines = len(line_map) == len(instructions)
 
-    # Update warp destinations with regards to the inserted instruction
-    _shift_warp_destinations(state, instructions, shift, index)
+        count = len(instructions)
 
-    # Update variable info ranges
-    _shift_debug_variable_info(state, shift, index)
+        inserts_at = [[] for _ in range(count + 1)]
+        for index, instruction in self.inserts:
+            inserts_at[index].append(instruction)
 
+        # Number of removed instructions before (and up to) an index, and of
+        # the instructions inserted before (and up to) an index
+        removed_before = [0] * (count + 1)
+        inserted_before = [0] * (count + 1)
 
-def _remove_instruction(state, instructions, index):
-    removed_instruction = instructions.pop(index)
-    state.debuginfo.addr_to_line_map.pop(index)
+        for addr in range(count):
+            removed_before[addr + 1] = removed_before[addr] + (addr in self.removals)
+            inserted_before[addr + 1] = inserted_before[addr] + len(inserts_at[addr])
 
-    # Offset
-    shift = -1
+        def to_inserts(addr):
+            if addr > count:
+                return forward(count) + addr - count
 
-    # Update warp destinations with regards to the removed instruction
-    _shift_warp_destinations(state, instructions, shift, index)
+            return addr - removed_before[addr] + inserted_before[addr]
 
-    # Update variable info ranges
-    _shift_debug_variable_info(state, shift, index)
+        def forward(addr):
+            if addr > count:
+                return forward(count) + addr - count
 
-    return removed_instruction
+            return addr - removed_before[addr] + inserted_before[addr] + len(inserts_at[addr])
 
+        def backward(addr):
+            return to_inserts(addr) - (addr <= count and addr in self.removals)
+
+        def relocate(addr, instruction, new_addr, lands_on_inserts):
+            destination = get_jump_destination(addr, instruction)
 
-def _shift_warp_destinations(state, instructions, shift, modified_index):
-    for current_index, moved_instruction in enumerate(instructions):
-        opcode = moved_instruction.opcode
+            if lands_on_inserts:
+                destination = to_inserts(destination)
+            elif instruction.CD >= 0:
+                destination = forward(destination)
+            else:
+                destination = backward(destination)
 
-        if opcode in _WARP_INSTRUCTIONS:
-            if current_index < modified_index and moved_instruction.CD >= 0:
-                destination = get_jump_destination(current_index, moved_instruction)
-                if destination > modified_index or (destination == modified_index and shift > 0):
-                    moved_instruction.CD += shift
+            set_jump_destination(new_addr, instruction, destination)
 
-            elif current_index >= modified_index and moved_instruction.CD < 0:
-                destination = current_index + moved_instruction.CD - shift + 1
-                if destination < modified_index or (destination == modified_index and shift > 0):
-                    moved_instruction.CD -= shift
+        new_instructions = []
+        new_lines = array.array(line_map.typecode)
 
+        for addr in range(count + 1):
+            for instruction in inserts_at[addr]:
+                if instruction.opcode in _WARP_INSTRUCTIONS:
+                    relocate(addr, instruction, len(new_instructions), False)
 
-def _shift_debug_variable_info(state, shift, modified_index):
-    for variable_info in state.debuginfo.variable_info:
+                new_instructions.append(instruction)
 
-        if variable_info.end_addr > modified_index \
-                or (shift > 0 and variable_info.end_addr == modified_index):
-            variable_info.end_addr += shift
+                if has_lines:
+                    new_lines.append(line_map[addr - 1])
 
-        if variable_info.start_addr > modified_index \
-                or (shift > 0 and variable_info.start_addr == modified_index):
-            variable_info.start_addr += shift
+            if addr == count or addr in self.removals:
+                continue
+
+            instruction = instructions[addr]
 
+            if instruction.opcode in _WARP_INSTRUCTIONS:
+                relocate(addr, instruction, len(new_instructions),
+                         addr in self.jumps_to_inserts)
 
-# Sets up _BINARY_OPERATOR_MAP and _COMPARISON_MAP
+            new_instructions.append(instruction)
+
+            if has_lines:
+                new_lines.append(line_map[addr])
+
+        instructions[:] = new_instructions
+
+        if has_lines:
+            line_map[:] = new_lines
+
+        for variable_info in self.state.debuginfo.variable_info:
+            variable_info.start_addr = forward(variable_info.start_addr)
+            variable_info.end_addr = forward(variable_info.end_addr)
+
+
+# Sets up _BINARY_OPERATOR_MAP, _COMPARISON_MAP and the other opcode-indexed
+# tables, opcodes is the list of (opcode, instruction) pairs of the version
 # The reason we have to do it in the init method is due to
 # the new initialisation system for opcodes. Previously,
 # they were set by the order they were specified in ljd.bytecode.instructions,
 # but now their opcode fields are set by ljd.rawdump.code.init from the luajit_opcode
 # files. This will eventually allow the decompiler to switch between
 # different LuaJIT versions.
-def init():
+def init(opcodes):
     global _BINARY_OPERATOR_MAP
     global _COMPARISON_MAP
 
@@ -1352,3 +1535,25 @@ def init():
     _WARP_INSTRUCTIONS = _JUMP_WARP_INSTRUCTIONS | {ins.FORL.opcode, ins.IFORL.opcode, ins.JFORL.opcode,
                                                     ins.ITERL.opcode, ins.IITERL.opcode, ins.JITERL.opcode,
                                                     ins.LOOP.opcode}
+
+    global _STATEMENT_BUILDERS
+    global _EXPRESSION_BUILDERS
+
+    # Unknown opcodes are left as None, _build_statement and
+    # _build_var_assignment assert on them just like they used to
+    _STATEMENT_BUILDERS = [None] * 256
+    _EXPRESSION_BUILDERS = [None] * 256
+
+    for opcode, definition in opcodes:
+        _STATEMENT_BUILDERS[opcode] = _select_statement_builder(definition)
+
+        if definition.A_type == ins.T_DST or definition.A_type == ins.T_UV:
+            _EXPRESSION_BUILDERS[opcode] = _select_expression_builder(opcode)
+
+    global _PEEPHOLE_RULES
+
+    _PEEPHOLE_RULES = [()] * 256
+
+    for definitions, rule in _PEEPHOLE_RULE_DEFINITIONS:
+        for definition in definitions:
+            _PEEPHOLE_RULES[definition.opcode] += (rule,)
@@ -8,8 +8,15 @@ import ljd.ast.nodes as nodes
 import ljd.ast.traverse as traverse
 
 
-def mark_locals(ast, alt_mode=False):
-    traverse.traverse(_LocalsMarker(alt_mode), ast)
+def mark_locals(ast, alt_mode=False, fused=None):
+    marker = _LocalsMarker(alt_mode)
+
+    # Other read-only passes (eg, the validator) may share the walk, they
+    # see every node before the marker does
+    if fused:
+        marker = traverse.MultiVisitor(*fused, marker)
+
+    traverse.traverse(marker, ast)
 
 
 def mark_local_definitions(ast):
@@ -194,6 +201,7 @@ class _LocalDefinitionsMarker(traverse.Visitor):
         super().__init__()
         self._states = []
         self._path = []
+        self._positions = []
 
     def _push_state(self):
         self._states.append(_LocalDefinitionsMarker._State())
@@ -281,11 +289,10 @@ class _LocalDefinitionsMarker(traverse.Visitor):
                 _, idx = _get_holder(self._path)
                 contents = self._path[idx + 1].contents
 
-                for node_index, child_node in enumerate(contents):
-                    if node != child_node:
-                        continue
+                node_index = self._positions[-1]
+                assert contents[node_index] is node
 
-                    contents.insert(node_index + 1, new_node)
+                contents.insert(node_index + 1, new_node)
 
                 # Split off the bad parts, so what remains is good for a local declaration
                 break
@@ -308,6 +315,17 @@ class _LocalDefinitionsMarker(traverse.Visitor):
 
         traverse.Visitor._leave_node(self, handler, node)
 
+    def _visit_list(self, nodes_list):
+        # Keep track of the position in the list, so split assignments can
+        # be inserted without searching for the original one
+        self._positions.append(-1)
+
+        for i, node in enumerate(nodes_list):
+            self._positions[-1] = i
+            self._visit(node)
+
+        self._positions.pop()
+
     def _visit(self, node):
         node_addr = getattr(node, "_addr", -1)
 
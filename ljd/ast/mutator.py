@@ -15,6 +15,7 @@ class SimpleLoopWarpSwapper(traverse.Visitor):
             self.jumps = []
 
     def __init__(self):
+        super().__init__()
         self._states = []
 
     def visit_function_definition(self, node):
@@ -40,6 +41,9 @@ class SimpleLoopWarpSwapper(traverse.Visitor):
 
             if use_break:
                 statement = nodes.Break()
+
+                # Where the break goes, for writing the warped AST
+                setattr(statement, "_target", target)
             else:
                 statement = target.contents[0]
                 target.contents = []
@@ -246,6 +250,10 @@ class SimpleLoopWarpSwapper(traverse.Visitor):
 
         del blocks[old_block_index]
 
+        # The blocks after it aren't visited yet, keep them numbered by their positions
+        for shifted_block in blocks[old_block_index:]:
+            shifted_block.index -= 1
+
         # Change block to restore the false condition
         new_warp = nodes.ConditionalWarp()
         new_warp.true_target = next_block
@@ -274,7 +282,7 @@ class MutatorVisitor(traverse.Visitor):
             return
 
         elseif = nodes.ElseIf()
-        if hasattr(subif, "_decompilation_error_here"):
+        if subif._decompilation_error_here:
             setattr(elseif, "_decompilation_error_here", True)
         elseif.expression = subif.expression
         elseif.then_block = subif.then_block
@@ -284,13 +292,20 @@ class MutatorVisitor(traverse.Visitor):
         node.else_block = subif.else_block
 
     def visit_statements_list(self, node):
+        node.contents = self._fill_constructors(node.contents)
+
+    # The blocks only survive up to here if the unwarper was skipped
+    def visit_block(self, node):
+        node.contents = self._fill_constructors(node.contents)
+
+    def _fill_constructors(self, statements):
         patched = []
 
         i = -1
 
-        while i < len(node.contents) - 1:
+        while i < len(statements) - 1:
             i += 1
-            statement = node.contents[i]
+            statement = statements[i]
 
             patched.append(statement)
 
@@ -306,9 +321,9 @@ class MutatorVisitor(traverse.Visitor):
 
             dst = statement.destinations.contents[0]
 
-            i += self._fill_constructor(dst, src, node.contents[i + 1:])
+            i += self._fill_constructor(dst, src, statements[i + 1:])
 
-        node.contents = patched
+        return patched
 
     @staticmethod
     def _fill_constructor(table, constructor, statements):
@@ -346,6 +361,19 @@ class MutatorVisitor(traverse.Visitor):
         return consumed
 
 
+# Purely cosmetic changes, done once the AST is final so that the writer
+# doesn't have to touch it
+class OutputVisitor(traverse.Visitor):
+    # ##
+
+    def visit_function_definition(self, node):
+        # Syntactic Sugar: Cull empty returns at the ends of functions
+        if len(node.statements.contents) > 1:
+            end_node = node.statements.contents[-1]
+            if isinstance(end_node, nodes.Return) and len(end_node.returns.contents) == 0:
+                node.statements.contents.pop(-1)
+
+
 def pre_pass(ast):
     traverse.traverse(SimpleLoopWarpSwapper(), ast)
 
@@ -356,3 +384,9 @@ def primary_pass(ast):
     traverse.traverse(MutatorVisitor(), ast)
 
     return ast
+
+
+def output_pass(ast):
+    traverse.traverse(OutputVisitor(), ast)
+
+    return ast
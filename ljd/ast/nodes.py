@@ -6,7 +6,17 @@
 # We should visit stuff in it's execution order. That's important
 
 
-class FunctionDefinition:
+# Markers the passes may attach to any node. They are declared here so that
+# checking them is a plain attribute read instead of a hasattr() probe.
+class Node:
+    # Source line of the statement, from the debug information
+    _line = None
+
+    # Set on the node following a block that failed to decompile
+    _decompilation_error_here = False
+
+
+class FunctionDefinition(Node):
     def __init__(self):
         self.arguments = IdentifiersList()
         self.statements = StatementsList()
@@ -28,36 +38,74 @@ class FunctionDefinition:
         visitor._leave_node(visitor.leave_function_definition, self)
 
 
-class TableConstructor:
-    anti_loop = set()
-    cur_visitor = None
+class TableConstructor(Node):
+    _LAZY_FIELDS = ("array", "records")
 
     def __init__(self):
         self.array = RecordsList()
         self.records = RecordsList()
 
+        # Constant table the records are still to be built from, see
+        # build_lazily()
+        self._template = None
+        self._builder = None
+
+    # Drops the records until one of the lists is first used, at which point
+    # builder(self, template) is called to fill them in. Tables that are only
+    # ever written never get their records built - the writer renders them
+    # straight from the template.
+    def build_lazily(self, template, builder):
+        for name in self._LAZY_FIELDS:
+            delattr(self, name)
+
+        self._template = template
+        self._builder = builder
+
+    # Only called for missing attributes, so this costs nothing once the
+    # records are built
+    def __getattr__(self, name):
+        template = self.__dict__.get("_template")
+
+        if template is None or name not in self._LAZY_FIELDS:
+            raise AttributeError(name)
+
+        builder = self._builder
+
+        self._template = None
+        self._builder = None
+
+        self.array = RecordsList()
+        self.records = RecordsList()
+
+        builder(self, template)
+
+        return getattr(self, name)
+
     def _accept(self, visitor):
-        if TableConstructor.cur_visitor is not None:
-            if TableConstructor.cur_visitor != visitor:
-                TableConstructor.cur_visitor = visitor
-                TableConstructor.anti_loop.clear()
-        else:
-            TableConstructor.cur_visitor = visitor
+        # Guard against a constructor ending up inside itself. Only the
+        # constructors on the current path are tracked, so nothing is kept
+        # once the walk is done.
+        active = visitor._table_constructors
 
-        if self in TableConstructor.anti_loop:
+        if self in active:
             return
 
-        TableConstructor.anti_loop.add(self)
+        active.add(self)
 
         visitor._visit_node(visitor.visit_table_constructor, self)
 
-        visitor._visit(self.array)
-        visitor._visit(self.records)
+        # Records still in the template are constants only, there is nothing
+        # in there for a pass to work on
+        if self._template is None:
+            visitor._visit(self.array)
+            visitor._visit(self.records)
 
         visitor._leave_node(visitor.leave_table_constructor, self)
 
+        active.discard(self)
+
 
-class ArrayRecord:
+class ArrayRecord(Node):
     def __init__(self):
         self.value = None
 
@@ -69,7 +117,7 @@ class ArrayRecord:
         visitor._leave_node(visitor.leave_array_record, self)
 
 
-class TableRecord:
+class TableRecord(Node):
     def __init__(self):
         self.key = None
         self.value = None
@@ -83,7 +131,7 @@ class TableRecord:
         visitor._leave_node(visitor.leave_table_record, self)
 
 
-class Assignment:
+class Assignment(Node):
     T_LOCAL_DEFINITION = 0
     T_NORMAL = 1
 
@@ -108,7 +156,7 @@ class Assignment:
         return "Assignment{" + str(self.destinations) + " <= " + str(self.expressions)
 
 
-class BinaryOperator:
+class BinaryOperator(Node):
     T_LOGICAL_OR = 0  # left or right
     T_LOGICAL_AND = 10  # left and right
 
@@ -227,7 +275,7 @@ class BinaryOperator:
             assert False
 
 
-class UnaryOperator:
+class UnaryOperator(Node):
     T_NOT = 60  # not operand
     T_LENGTH_OPERATOR = 61  # #operand
     T_MINUS = 62  # -operand
@@ -254,7 +302,7 @@ class UnaryOperator:
         return BinaryOperator.PR_UNARY
 
 
-class StatementsList:
+class StatementsList(Node):
     def __init__(self):
         self.contents = []
 
@@ -266,7 +314,7 @@ class StatementsList:
         visitor._leave_node(visitor.leave_statements_list, self)
 
 
-class IdentifiersList:
+class IdentifiersList(Node):
     def __init__(self):
         self.contents = []
 
@@ -278,7 +326,7 @@ class IdentifiersList:
         visitor._leave_node(visitor.leave_identifiers_list, self)
 
 
-class RecordsList:
+class RecordsList(Node):
     def __init__(self):
         self.contents = []
 
@@ -290,7 +338,7 @@ class RecordsList:
         visitor._leave_node(visitor.leave_records_list, self)
 
 
-class VariablesList:
+class VariablesList(Node):
     def __init__(self):
         self.contents = []
 
@@ -305,7 +353,7 @@ class VariablesList:
         return "VarList[" + ",".join([str(v) for v in self.contents]) + "]"
 
 
-class ExpressionsList:
+class ExpressionsList(Node):
     def __init__(self):
         self.contents = []
 
@@ -321,7 +369,7 @@ class ExpressionsList:
 
 
 # Called Name in the Lua 5.1 reference
-class Identifier:
+class Identifier(Node):
     T_SLOT = 0
     T_LOCAL = 1
     T_UPVALUE = 2
@@ -367,13 +415,13 @@ class Identifier:
 
 # helper vararg/varreturn
 
-class MULTRES:
+class MULTRES(Node):
     def _accept(self, visitor):
         visitor._visit_node(visitor.visit_multres, self)
         visitor._leave_node(visitor.leave_multres, self)
 
 
-class TableElement:
+class TableElement(Node):
     def __init__(self):
         self.table = None
         self.key = None
@@ -393,13 +441,13 @@ class TableElement:
         return "{0}@{1}".format(str(self.key), str(self.table))
 
 
-class Vararg:
+class Vararg(Node):
     def _accept(self, visitor):
         visitor._visit_node(visitor.visit_vararg, self)
         visitor._leave_node(visitor.leave_vararg, self)
 
 
-class FunctionCall:
+class FunctionCall(Node):
     def __init__(self):
         self.function = None
         self.arguments = ExpressionsList()
@@ -417,7 +465,7 @@ class FunctionCall:
         return "{FunctionCall: { function: " + str(self.function) + ", arguments: " + str(self.arguments) + "} }"
 
 
-class If:
+class If(Node):
     def __init__(self):
         self.expression = None
         self.then_block = StatementsList()
@@ -437,7 +485,7 @@ class If:
         visitor._leave_node(visitor.leave_if, self)
 
 
-class ElseIf:
+class ElseIf(Node):
     def __init__(self):
         self.expression = None
         self.then_block = StatementsList()
@@ -454,7 +502,7 @@ class ElseIf:
 # ##
 
 
-class Block:
+class Block(Node):
     def __init__(self):
         self.index = -1
         self.warp = None
@@ -480,7 +528,7 @@ class Block:
                ", loop: " + str(self.loop) + "}}"
 
 
-class UnconditionalWarp:
+class UnconditionalWarp(Node):
     T_JUMP = 0
     T_FLOW = 1
 
@@ -502,7 +550,7 @@ class UnconditionalWarp:
                + ", is_uclo: " + str(self.is_uclo) + " }}"
 
 
-class ConditionalWarp:
+class ConditionalWarp(Node):
     def __init__(self):
         self.condition = None
         self.true_target = None
@@ -524,7 +572,7 @@ class ConditionalWarp:
                + "} }"
 
 
-class IteratorWarp:
+class IteratorWarp(Node):
     def __init__(self):
         self.variables = VariablesList()
         self.controls = ExpressionsList()
@@ -542,7 +590,7 @@ class IteratorWarp:
         visitor._leave_node(visitor.leave_iterator_warp, self)
 
 
-class NumericLoopWarp:
+class NumericLoopWarp(Node):
     def __init__(self):
         self.index = Identifier()
         self.controls = ExpressionsList()
@@ -560,7 +608,7 @@ class NumericLoopWarp:
         visitor._leave_node(visitor.leave_numeric_loop_warp, self)
 
 
-class EndWarp:
+class EndWarp(Node):
     def _accept(self, visitor):
         visitor._visit_node(visitor.visit_end_warp, self)
         visitor._leave_node(visitor.leave_end_warp, self)
@@ -572,7 +620,7 @@ class EndWarp:
 # ##
 
 
-class Return:
+class Return(Node):
     def __init__(self):
         self.returns = ExpressionsList()
 
@@ -584,13 +632,13 @@ class Return:
         visitor._leave_node(visitor.leave_return, self)
 
 
-class Break:
+class Break(Node):
     def _accept(self, visitor):
         visitor._visit_node(visitor.visit_break, self)
         visitor._leave_node(visitor.leave_break, self)
 
 
-class While:
+class While(Node):
     def __init__(self):
         self.expression = None
         self.statements = StatementsList()
@@ -604,7 +652,7 @@ class While:
         visitor._leave_node(visitor.leave_while, self)
 
 
-class RepeatUntil:
+class RepeatUntil(Node):
     def __init__(self):
         self.expression = None
         self.statements = StatementsList()
@@ -618,7 +666,7 @@ class RepeatUntil:
         visitor._leave_node(visitor.leave_repeat_until, self)
 
 
-class NumericFor:
+class NumericFor(Node):
     def __init__(self):
         self.variable = None
         self.expressions = ExpressionsList()
@@ -634,7 +682,7 @@ class NumericFor:
         visitor._leave_node(visitor.leave_numeric_for, self)
 
 
-class IteratorFor:
+class IteratorFor(Node):
     def __init__(self):
         self.expressions = ExpressionsList()
         self.identifiers = VariablesList()
@@ -650,7 +698,7 @@ class IteratorFor:
         visitor._leave_node(visitor.leave_iterator_for, self)
 
 
-class Constant:
+class Constant(Node):
     T_INTEGER = 0
     T_FLOAT = 1
     T_STRING = 2
@@ -668,7 +716,7 @@ class Constant:
         return str(self.value)
 
 
-class Primitive:
+class Primitive(Node):
     T_NIL = 0
     T_TRUE = 1
     T_FALSE = 2
@@ -684,7 +732,7 @@ class Primitive:
         return ["nil", "True", "False"][self.type]
 
 
-class NoOp:
+class NoOp(Node):
     def __init__(self):
         pass
 
@@ -3,6 +3,9 @@ import ljd.ast.nodes as nodes
 _printers = {}
 _indent_unit = '\t'
 
+# Declared on every node, but only worth showing once a pass has set them
+_NODE_MARKERS = [name for name in vars(nodes.Node) if not name.startswith("__")]
+
 
 def dump(name, obj, level=0, **kwargs):
     indent = level * _indent_unit
@@ -45,6 +48,9 @@ def _print_default(obj, prefix, level, exclude_blocks=False, extra_attrs=None):
         if key.startswith("__") or key in header_keys:
             continue
 
+        if key in _NODE_MARKERS and key not in vars(obj):
+            continue
+
         val = getattr(obj, key)
 
         # Exclude methods, they're of no use
@@ -64,10 +70,11 @@ def _header(prefix, obj, attrs=None, suffix="", **values):
         attrs = ["_addr", "_line"]
 
     for name in attrs:
-        if not hasattr(obj, name):
+        value = getattr(obj, name, None)
+        if value is None:
             continue
         pretty_name = name.lstrip("_")
-        values[pretty_name] = getattr(obj, name)
+        values[pretty_name] = value
 
     if len(values) == 0:
         attr_block = ""
@@ -78,9 +78,11 @@ class RefsProcessData:
 def eliminate_temporary(ast, ignore_ambiguous=True, identify_slots=False, safe_mode=True, unwarped=False):
     _eliminate_multres(ast)
 
-    slots, unused = _collect_slots(ast, identify_slots=identify_slots, unwarped=unwarped)
+    positions = _ListPositions()
+
+    slots, unused = _collect_slots(ast, positions, identify_slots=identify_slots, unwarped=unwarped)
     _sort_slots(slots)
-    _eliminate_temporary(ast, slots, ignore_ambiguous, safe_mode=safe_mode, unwarped=unwarped)
+    _eliminate_temporary(ast, slots, positions, ignore_ambiguous, safe_mode=safe_mode, unwarped=unwarped)
 
     # _remove_unused(unused)
 
@@ -90,17 +92,18 @@ def eliminate_temporary(ast, ignore_ambiguous=True, identify_slots=False, safe_m
     return ast
 
 
-def simplify_ast(ast, dirty_callback=None):
-    traverse.traverse(_SimplifyVisitor(dirty_callback=dirty_callback), ast)
+def simplify_ast(ast, dirty_callback=None, positions=None):
+    traverse.traverse(_SimplifyVisitor(dirty_callback=dirty_callback, positions=positions), ast)
 
 
-def _eliminate_temporary(ast, slots, ignore_ambiguous=True, safe_mode=True, unwarped=False):
+def _eliminate_temporary(ast, slots, positions, ignore_ambiguous=True, safe_mode=True, unwarped=False):
     data = RefsProcessData(slots, [], [], [], [], [])
 
     _fill_refs(data, ignore_ambiguous and safe_mode, True)
 
-    _eliminate_simple_cases(data.simple)
-    _recheck_unsafe_cases(ast, data.unsafe, ignore_ambiguous=False, safe_mode=safe_mode, unwarped=unwarped)
+    _eliminate_simple_cases(data.simple, positions)
+    _recheck_unsafe_cases(ast, data.unsafe, positions, ignore_ambiguous=False, safe_mode=safe_mode,
+                          unwarped=unwarped)
 
     _eliminate_into_table_constructors(data.tables)
     _eliminate_mass_assignments(data.massive)
@@ -145,7 +148,7 @@ def _fill_refs(data: RefsProcessData, ignore_ambiguous=True, safe_mode=True):
             _fill_simple_refs(info, data, ignore_ambiguous, safe_mode)
 
 
-def _recheck_unsafe_cases(ast, unsafe, ignore_ambiguous, safe_mode=True, unwarped=False):
+def _recheck_unsafe_cases(ast, unsafe, positions, ignore_ambiguous, safe_mode=True, unwarped=False):
     if not unsafe:
         return
 
@@ -170,7 +173,7 @@ def _recheck_unsafe_cases(ast, unsafe, ignore_ambiguous, safe_mode=True, unwarpe
         _cleanup_invalid_nodes(node)
 
         # Collect slots in the block, but only keep those that were deemed unsafe to eliminate before.
-        new_slots, _ = _collect_slots(node, unwarped=unwarped)
+        new_slots, _ = _collect_slots(node, positions, unwarped=unwarped)
         if safe_mode:
             for idx, info in enumerate(new_slots):
                 if (str(info.slot) + "#" + str(info.slot_id)) not in slots:
@@ -181,13 +184,13 @@ def _recheck_unsafe_cases(ast, unsafe, ignore_ambiguous, safe_mode=True, unwarpe
         new_data = RefsProcessData(new_slots, [], [], [], [], [])
 
         _fill_refs(new_data, ignore_ambiguous and safe_mode, safe_mode)
-        _eliminate_simple_cases(new_data.simple)
+        _eliminate_simple_cases(new_data.simple, positions)
 
     if unwarped:
-        simplify_ast(ast, dirty_callback=_node_dirty_cb)
+        simplify_ast(ast, dirty_callback=_node_dirty_cb, positions=positions)
     else:
         for block in blocks:
-            simplify_ast(block, dirty_callback=_node_dirty_cb)
+            simplify_ast(block, dirty_callback=_node_dirty_cb, positions=positions)
 
 
 def _fill_massive_refs(info, data: RefsProcessData, ignore_ambiguous, safe_mode=True):
@@ -364,7 +367,7 @@ def _get_holder(path):
     return None
 
 
-def _eliminate_simple_cases(simple):
+def _eliminate_simple_cases(simple, positions):
     for info, ref, src in simple:
         holder = ref.path[-2]
         dst = ref.identifier
@@ -412,14 +415,14 @@ def _eliminate_simple_cases(simple):
             if function.is_method and \
                     (not isinstance(function, nodes.TableElement)
                      or function.key.type != nodes.Constant.T_STRING):
-                function.arguments.contents.insert(0, holder.table)
+                positions.insert(function.arguments, 0, holder.table)
                 function.is_method = False
 
         _mark_invalidated(info.assignment)
 
         if isinstance(holder, LIST_TYPES):
             conts = holder.contents
-            found = _replace_node_in_list(conts, dst, src)
+            found = _replace_node_in_list(conts, dst, src, ref.index)
         else:
             found = _replace_node(holder, dst, src)
 
@@ -475,7 +478,7 @@ def _eliminate_mass_assignments(massive):
             continue
 
         destinations = info.assignment.destinations.contents
-        found = _replace_node_in_list(destinations, identifier, globalvar)
+        found = _replace_node_in_list(destinations, identifier, globalvar, info.references[0].index)
 
         _mark_invalidated(base_assignment)
 
@@ -491,10 +494,9 @@ def _replace_node(holder, original, replacement):
     return False
 
 
-def _replace_node_in_list(node_list, original, replacement):
-    try:
-        index = node_list.index(original)
-    except ValueError:
+# The index is the reference's position, which _ListPositions keeps up to date
+def _replace_node_in_list(node_list, original, replacement, index):
+    if not 0 <= index < len(node_list) or node_list[index] is not original:
         return False
 
     node_list[index] = replacement
@@ -548,8 +550,8 @@ def _remove_unused(unused):
     pass
 
 
-def _collect_slots(ast, identify_slots=False, unwarped=False):
-    collector = _SlotsCollector(identify_slots, unwarped)
+def _collect_slots(ast, positions, identify_slots=False, unwarped=False):
+    collector = _SlotsCollector(positions, identify_slots, unwarped)
     traverse.traverse(collector, ast)
 
     return collector.slots, collector.unused
@@ -623,6 +625,36 @@ class SlotReference:
         self.path = []
         self.identifier = None
 
+        # Position of the identifier in its holder, if the holder is a list
+        self.index = -1
+
+
+# The slot references sitting right in a list, by the list. The positions of
+# these are recorded while collecting them, and the insertions and removals
+# made while eliminating slots go through here to keep them up to date.
+class _ListPositions:
+    def __init__(self):
+        self._references = {}
+
+    def add(self, holder, reference):
+        self._references.setdefault(holder, []).append(reference)
+
+    def insert(self, holder, index, node):
+        holder.contents.insert(index, node)
+
+        for reference in self._references.get(holder, ()):
+            if reference.index >= index:
+                reference.index += 1
+
+    def remove(self, holder, index):
+        del holder.contents[index]
+
+        for reference in self._references.get(holder, ()):
+            if reference.index > index:
+                reference.index -= 1
+            elif reference.index == index:
+                reference.index = -1
+
 
 class SlotInfo:
     references: List[SlotReference]
@@ -656,10 +688,12 @@ class _SlotsCollector(traverse.Visitor):
 
     # ##
 
-    def __init__(self, identify_slots=False, unwarped=False):
+    def __init__(self, positions, identify_slots=False, unwarped=False):
         super().__init__()
         self._states = []
         self._path = []
+        self._positions = []
+        self._list_positions = positions
         self._root = None
         self._skip = None
         self._next_slot_id = 0
@@ -829,6 +863,12 @@ class _SlotsCollector(traverse.Visitor):
         # Copy the list, but not contents
         reference.path = self._path[:]
 
+        holder = self._path[-2]
+
+        if isinstance(holder, LIST_TYPES):
+            reference.index = self._positions[-1]
+            self._list_positions.add(holder, reference)
+
         info.references.append(reference)
 
     # ##
@@ -924,6 +964,17 @@ class _SlotsCollector(traverse.Visitor):
 
         traverse.Visitor._leave_node(self, handler, node)
 
+    def _visit_list(self, nodes_list):
+        # Remember where each node sits in its list, so the references can
+        # be replaced later on without searching for them
+        self._positions.append(-1)
+
+        for i, node in enumerate(nodes_list):
+            self._positions[-1] = i
+            self._visit(node)
+
+        self._positions.pop()
+
     def _visit(self, node):
         if self._skip == node:
             return
@@ -956,11 +1007,12 @@ class _TreeCleanup(traverse.Visitor):
 
 class _SimplifyVisitor(traverse.Visitor):
 
-    def __init__(self, dirty_callback=None):
+    def __init__(self, dirty_callback=None, positions=None):
         super().__init__()
         self._dirty = False
         self._dirty_cb = dirty_callback
         self._root = None
+        self._positions = positions or _ListPositions()
 
     def _visit_node(self, handler, node):
         if not self._root:
@@ -1012,4 +1064,4 @@ class _SimplifyVisitor(traverse.Visitor):
 
         self._dirty = True
         node.is_method = True
-        del args[0]
+        self._positions.remove(node.arguments, 0)
@@ -0,0 +1,90 @@
+#
+# Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
+#
+
+import io
+import pickle
+
+import ljd.ast.nodes as nodes
+import ljd.ast.traverse as traverse
+import ljd.bytecode.constants as constants
+import ljd.bytecode.debuginfo as debuginfo
+
+# Pickled copies of warped code, to go back to when something goes wrong with
+# it. That's a lot cheaper than a deep copy, and only has to be undone on the
+# rare occasions it does. The constants and the debug information never change
+# after parsing, so they are kept as they are instead of being copied.
+_SHARED_TYPES = {constants.Table, debuginfo.VariableInfo, debuginfo.DebugInformation}
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, stream, shared_types):
+        super().__init__(stream, pickle.HIGHEST_PROTOCOL)
+        self.shared_types = _SHARED_TYPES | set(shared_types)
+        self.shared = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in self.shared_types:
+            return None
+
+        self.shared[id(obj)] = obj
+        return id(obj)
+
+
+# All the function definitions of a node, outermost first
+class FunctionsCollector(traverse.Visitor):
+    def __init__(self):
+        super().__init__()
+        self.result = []
+
+    def visit_function_definition(self, node):
+        self.result.append(node)
+
+
+def _take(node, statements_lists, shared_types):
+    stream = io.BytesIO()
+
+    pickler = _Pickler(stream, shared_types)
+
+    # Pickling a block pulls in the blocks its warp jumps to, which would make
+    #  one long chain of all the blocks. Most of the jumps go forward, so going
+    #  backwards keeps that shallow.
+    blocks = [statements.contents[::-1] for statements in statements_lists]
+
+    try:
+        pickler.dump((blocks, node))
+    except RecursionError:
+        return None
+
+    return stream.getvalue(), pickler.shared
+
+
+# Snapshot of the (warped) body of a single function. The nested functions are
+#  kept as they are when shared_types has FunctionDefinition in it.
+# Returns None if the function is too deep to be pickled
+def take(statements, shared_types=()):
+    return _take(statements, [statements], shared_types)
+
+
+# Snapshot of a whole (warped) function, nested functions included
+# Returns None if the function is too deep to be pickled
+def take_function(function):
+    collector = FunctionsCollector()
+    traverse.traverse(collector, function)
+
+    # The innermost functions first, so that nothing is left to pull in by
+    #  the time a function definition is reached
+    statements_lists = [node.statements for node in reversed(collector.result)]
+
+    return _take(function, statements_lists, ())
+
+
+# Returns a new copy of the snapshotted node each time it's called
+def restore(snapshot):
+    data, shared = snapshot
+
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = shared.__getitem__
+
+    _, node = unpickler.load()
+    return node
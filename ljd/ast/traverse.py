@@ -1,6 +1,8 @@
 class Visitor:
     def __init__(self):
-        pass
+        # Table constructors currently being walked, used to stop on loops
+        # within the tree. It only lives as long as the visitor does.
+        self._table_constructors = set()
 
     # ##
 
@@ -244,6 +246,44 @@ class Visitor:
             self._visit(node)
 
 
+class MultiVisitor(Visitor):
+    # Drives several visitors through a single walk of the tree. Every node is
+    # handed to the visitors in the order they were given (and left in the
+    # reverse order), so this is only valid for visitors which don't depend
+    # on each other's mutations. The visitors must not override _visit or
+    # _visit_list, as the walk itself belongs to the MultiVisitor.
+
+    def __init__(self, *visitors):
+        super().__init__()
+
+        for visitor in visitors:
+            assert type(visitor)._visit is Visitor._visit \
+                   and type(visitor)._visit_list is Visitor._visit_list, \
+                "{0} controls its own traversal and can't be fused".format(type(visitor).__name__)
+
+        self.visitors = visitors
+        self._handlers = {}
+
+    def _get_handlers(self, handler):
+        name = handler.__name__
+
+        handlers = self._handlers.get(name)
+
+        if handlers is None:
+            handlers = [(visitor, getattr(visitor, name)) for visitor in self.visitors]
+            self._handlers[name] = handlers
+
+        return handlers
+
+    def _visit_node(self, handler, node):
+        for visitor, visitor_handler in self._get_handlers(handler):
+            visitor._visit_node(visitor_handler, node)
+
+    def _leave_node(self, handler, node):
+        for visitor, visitor_handler in reversed(self._get_handlers(handler)):
+            visitor._leave_node(visitor_handler, node)
+
+
 def traverse(visitor, node):
     if isinstance(node, list):
         visitor._visit_list(node)
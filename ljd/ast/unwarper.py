@@ -1,8 +1,10 @@
 import copy
 import sys
+import time
 
 import ljd.ast.nodes as nodes
 import ljd.ast.slotworks as slotworks
+import ljd.ast.snapshot
 import ljd.ast.traverse as traverse
 from ljd.ast.helpers import *
 
@@ -11,6 +13,19 @@ binop = nodes.BinaryOperator
 verbose = False
 catch_asserts = False
 
+# Seconds a single function may spend in the unwarper, None for no limit. See
+# unwarp() for what happens to the functions going over it.
+function_time_budget = None
+
+# Put the functions the unwarper fails on back the way they were, instead of
+# failing the whole node (or, with catch_asserts, going on with whatever state
+# the failing step left them in). See unwarp().
+rollback_failures = False
+
+# When the function being unwarped runs out of time, checked all along the
+# slower steps by _check_deadline()
+_deadline = None
+
 
 def exp_debug(*args):
     if verbose:
@@ -33,31 +48,187 @@ class _StatementsCollector(traverse.Visitor):
         self.result = []
 
     def visit_statements_list(self, node):
-        if len(node.contents) > 0 or hasattr(node, "_decompilation_error_here"):
+        if len(node.contents) > 0 or node._decompilation_error_here:
             self.result.append(node)
 
 
-class _FunctionsCollector(traverse.Visitor):
+# Only the statements lists of a single function, not of the nested ones
+class _FunctionStatementsCollector(_StatementsCollector):
+    def __init__(self, function):
+        super().__init__()
+        self.function = function
+
+    def _visit(self, node):
+        if isinstance(node, nodes.FunctionDefinition) and node is not self.function:
+            return
+
+        super()._visit(node)
+
+
+class _FunctionsCollector(ljd.ast.snapshot.FunctionsCollector):
     def __init__(self):
         super().__init__()
-        self.result = []
+
+        # The functions directly nested in each function
+        self.children = {}
+        self._parents = []
 
     def visit_function_definition(self, node):
-        self.result.append(node)
+        super().visit_function_definition(node)
+        self.children[node] = []
+
+        if self._parents:
+            self.children[self._parents[-1]].append(node)
+
+        self._parents.append(node)
+
+    def leave_function_definition(self, node):
+        self._parents.pop()
+
 
+# Not an Exception, so that the catch_asserts handlers let it through
+class _BudgetExceeded(BaseException):
+    pass
+
+
+def _check_deadline():
+    if _deadline is not None and time.monotonic() > _deadline:
+        raise _BudgetExceeded()
+
+
+# Returns the functions given up on, mapped to their warped statements and the
+# reason why. That only happens with a deadline for the whole node, with a
+# function_time_budget or with rollback_failures set, in which case the
+# functions are unwarped one by one. A function running out of time (or
+# failing) is put back the way it was, along with all the functions nested in
+# it, and its body is swapped for an empty one, so the passes working on the
+# unwarped AST never see the blocks. It's up to the caller to put the warped
+# statements back once these passes are done.
+def unwarp(node, conservative=False, deadline=None):
+    if deadline is None and function_time_budget is None and not rollback_failures:
+        _unwarp_flows(node)
+
+        # Gluing the flows doesn't add or remove any functions, so both lists
+        # can be gathered in one walk
+        statements_collector = _StatementsCollector()
+        functions_collector = _FunctionsCollector()
+        traverse.traverse(traverse.MultiVisitor(statements_collector, functions_collector), node)
+
+        try:
+            _glue_flows(node, statements_collector.result, conservative)
+        except:
+            if catch_asserts:
+                print("-- Decompilation Error: _glue_flows(node)\n", file=sys.stdout)
+            else:
+                raise
+
+        functions = functions_collector.result
+        degraded = {}
+    else:
+        functions, degraded = _unwarp_functions(node, conservative, deadline)
+
+    try:
+        _trim_redundant_returns(functions)
+    except:
+        if catch_asserts:
+            print("-- Decompilation Error: _trim_redundant_returns(node)\n", file=sys.stdout)
+        else:
+            raise
 
-def unwarp(node, conservative=False):
     try:
-        _run_step(_fix_loops, node, repeat_until=False)
-        _run_step(_fix_loops, node, repeat_until=True)
+        slotworks.simplify_ast(node)
     except:
         if catch_asserts:
+            print("-- Decompilation Error: ljd.ast.slotworks.simplify_ast(self.ast)\n", file=sys.stdout)
+        else:
+            raise
+
+    return degraded
+
+
+def _unwarp_functions(node, conservative, deadline):
+    global _deadline
+
+    collector = _FunctionsCollector()
+    traverse.traverse(collector, node)
+
+    degraded = {}
+    skipped = set()
+
+    # Outermost first, so that the functions nested in one that is given up
+    #  on haven't been touched yet
+    for function in collector.result:
+        children = collector.children[function]
+
+        if function in skipped:
+            skipped.update(children)
+            continue
+
+        snapshot = ljd.ast.snapshot.take(function.statements, {nodes.FunctionDefinition})
+
+        # Nothing to go back to, so it is given up on from the start
+        if snapshot is None:
+            degraded[function] = (function.statements, "too deeply nested to be rolled back")
+            function.statements = nodes.StatementsList()
+
+            skipped.update(children)
+            continue
+
+        _deadline = deadline
+
+        if function_time_budget is not None:
+            function_deadline = time.monotonic() + function_time_budget
+
+            if deadline is None or function_deadline < deadline:
+                _deadline = function_deadline
+
+        reason = None
+
+        try:
+            _check_deadline()
+
+            # With rollback_failures, errors come through here instead of
+            #  leaving the function half unwarped
+            _unwarp_flows(function, nested=False, catch=not rollback_failures)
+
+            try:
+                _glue_flows(function, _gather_statements_lists(function, nested=False), conservative)
+            except:
+                if catch_asserts and not rollback_failures:
+                    print("-- Decompilation Error: _glue_flows(node)\n", file=sys.stdout)
+                else:
+                    raise
+        except _BudgetExceeded:
+            reason = "time budget exceeded"
+        except Exception as exc:
+            if not rollback_failures:
+                raise
+
+            reason = "unwarping failed ({0}: {1})".format(type(exc).__name__, exc)
+        finally:
+            _deadline = None
+
+        if reason is not None:
+            degraded[function] = (ljd.ast.snapshot.restore(snapshot), reason)
+            function.statements = nodes.StatementsList()
+
+            skipped.update(children)
+
+    return collector.result, degraded
+
+
+def _unwarp_flows(node, nested=True, catch=True):
+    try:
+        _run_step(_fix_loops, node, repeat_until=False, nested=nested)
+        _run_step(_fix_loops, node, repeat_until=True, nested=nested)
+    except:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_fix_loops, node)\n", file=sys.stdout)
         else:
             raise
 
     try:
-        _run_step(_unwarp_expressions, node)
+        _run_step(_unwarp_expressions, node, nested=nested)
 
         # Under some conditions the expressions unwarper causes new assignments to become expressions themselves.
         # Instead of doing some difficult bookkeeping, we just unwarp expressions again.
@@ -65,9 +236,9 @@ def unwarp(node, conservative=False):
         # An example where this is needed is an expression like x = x or { a and b }
         #
         # There's probably a better (read: faster) way to do this, but it works for now.
-        _run_step(_unwarp_expressions, node)
+        _run_step(_unwarp_expressions, node, nested=nested)
     except:
-        if catch_asserts:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_unwarp_expressions, node)\n", file=sys.stdout)
         else:
             raise
@@ -75,92 +246,72 @@ def unwarp(node, conservative=False):
     # There could be many negative jumps within while conditions, so
     # filter them first
     try:
-        _run_step(_unwarp_loops, node, repeat_until=False)
+        _run_step(_unwarp_loops, node, repeat_until=False, nested=nested)
     except:
-        if catch_asserts:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_unwarp_loops, node, repeat_until=False)\n", file=sys.stdout)
         else:
             raise
 
     try:
-        _run_step(_unwarp_loops, node, repeat_until=True)
+        _run_step(_unwarp_loops, node, repeat_until=True, nested=nested)
     except:
-        if catch_asserts:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_unwarp_loops, node, repeat_until=True)\n", file=sys.stdout)
         else:
             raise
 
     try:
-        _run_step(_unwarp_ifs, node)
+        _run_step(_unwarp_ifs, node, nested=nested)
     except:
-        if catch_asserts:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_unwarp_ifs, node)\n", file=sys.stdout)
         else:
             raise
 
     try:
-        _run_step(_cleanup_ast, node)
-        pass
+        _run_step(_cleanup_ast, node, nested=nested)
     except:
-        if catch_asserts:
+        if catch and catch_asserts:
             print("-- Decompilation Error: _run_step(_cleanup_ast, node)\n", file=sys.stdout)
         else:
             raise
 
-    try:
-        _glue_flows(node, conservative)
-    except:
-        if catch_asserts:
-            print("-- Decompilation Error: _glue_flows(node)\n", file=sys.stdout)
-        else:
-            raise
-
-    try:
-        _trim_redundant_returns(node)
-    except:
-        if catch_asserts:
-            print("-- Decompilation Error: _trim_redundant_returns(node)\n", file=sys.stdout)
-        else:
-            raise
-
-    try:
-        slotworks.simplify_ast(node)
-    except:
-        if catch_asserts:
-            print("-- Decompilation Error: ljd.ast.slotworks.simplify_ast(self.ast)\n", file=sys.stdout)
-        else:
-            raise
-
 
-def _run_step(step, node, **kargs):
-    for statements in _gather_statements_lists(node):
+def _run_step(step, node, nested=True, **kargs):
+    for statements in _gather_statements_lists(node, nested):
+        _check_deadline()
         statements.contents = step(statements.contents, **kargs)
 
     # Fix block indices in case anything was moved
-    for statements in _gather_statements_lists(node):
+    for statements in _gather_statements_lists(node, nested):
         for i, block in enumerate(statements.contents):
             if block.index != i:
                 block.former_index = block.index
                 block.index = i
 
 
-def _gather_statements_lists(node):
-    collector = _StatementsCollector()
+def _gather_statements_lists(node, nested=True):
+    if nested:
+        collector = _StatementsCollector()
+    else:
+        collector = _FunctionStatementsCollector(node)
+
     traverse.traverse(collector, node)
     return collector.result
 
 
-def _glue_flows(node, conservative=False):
+def _glue_flows(node, statements_lists, conservative=False):
     error_pending = False
 
-    for statements in _gather_statements_lists(node):
+    for statements in statements_lists:
         blocks = statements.contents
 
         # TODO(yzg): 'Return' object has no attribute 'contents'
         assert isinstance(blocks[-1], nodes.Return) or isinstance(blocks[-1].warp, nodes.EndWarp)
 
         for i, block in enumerate(blocks[:-1]):
-            if hasattr(block, "_decompilation_error_here"):
+            if block._decompilation_error_here:
                 error_pending = True
             if len(block.contents) == 0:
                 continue
@@ -187,11 +338,8 @@ def _glue_flows(node, conservative=False):
 
 
 # Delete returns on the last line of a function, when those returns don't have any arguments
-def _trim_redundant_returns(node):
-    collector = _FunctionsCollector()
-    traverse.traverse(collector, node)
-
-    for funcdef in collector.result:
+def _trim_redundant_returns(functions):
+    for funcdef in functions:
         statements = funcdef.statements.contents
 
         if not statements:
@@ -216,6 +364,8 @@ def _unwarp_expressions(blocks):
     start_index = 0
     end_index = 0
     while start_index < len(blocks) - 1:
+        _check_deadline()
+
         start = blocks[start_index]
         warp = start.warp
 
@@ -325,6 +475,8 @@ def _unwarp_ifs(blocks, top_end=None, topmost_end=None):
     start_index = 0
 
     while start_index < len(blocks) - 1:
+        _check_deadline()
+
         start = blocks[start_index]
         warp = start.warp
 
@@ -745,6 +897,8 @@ def _find_expressions(start, body, end, level=0, known_blocks=None):
     #  significantly shorter, easier to read readable, and should in fact run faster too.
 
     while i < len(extbody):
+        _check_deadline()
+
         current_i = i
         i += 1
         block = extbody[current_i]
@@ -1772,6 +1926,8 @@ def _fix_loops(blocks, repeat_until):
     replacements = {}
 
     for start, end in fixed:
+        _check_deadline()
+
         end = replacements.get(end, end)
         start_index = blocks.index(start)
         end_index = blocks.index(end)
@@ -1836,6 +1992,8 @@ def _fix_loops(blocks, repeat_until):
                 before = blocks[:body_start_index]
             blocks = before + [block] + blocks[end_index:]
 
+        body_set = set(body)
+
         for i, block in enumerate(body):
             warp = block.warp
 
@@ -1843,11 +2001,13 @@ def _fix_loops(blocks, repeat_until):
                 assert _get_target(warp) == body[i + 1]
 
             if isinstance(warp, nodes.ConditionalWarp):
-                assert warp.true_target in body
-                assert warp.false_target in body
+                assert warp.true_target in body_set
+                assert warp.false_target in body_set
             elif isinstance(warp, nodes.UnconditionalWarp):
                 if warp.target:
-                    assert warp.target in body
+                    assert warp.target in body_set
+
+    blocks_set = set(blocks)
 
     for i, block in enumerate(blocks):
         warp = block.warp
@@ -1856,12 +2016,12 @@ def _fix_loops(blocks, repeat_until):
             assert _get_target(warp) == blocks[i + 1]
 
         if isinstance(warp, nodes.ConditionalWarp):
-            assert warp.true_target in blocks
-            assert warp.false_target in blocks
+            assert warp.true_target in blocks_set
+            assert warp.false_target in blocks_set
         else:
             target = _get_target(warp, True)
             if target:
-                assert target in blocks
+                assert target in blocks_set
 
     return blocks
 
@@ -2453,8 +2613,7 @@ def _find_all_loops(blocks, repeat_until):
             i = last_i
 
             # There always should be at least one return block
-            end_index = blocks.index(end)
-            end = blocks[end_index + 1]
+            end = blocks[last_i + 1]
 
             loops.append((start, end))
 
@@ -2465,14 +2624,6 @@ def _find_all_loops(blocks, repeat_until):
     return list(reversed(sorted(loops, key=lambda x: x[0].index)))
 
 
-def _get_previous_block(block, blocks):
-    block_index = blocks.index(block)
-
-    assert block_index > 0
-
-    return blocks[block_index - 1]
-
-
 # Remove any unnecessary empty blocks (ie, those which are only flowed into once), and
 #  merge any two blocks where the first flows into the second, and only the first warps to
 #  the second.
@@ -2503,14 +2654,14 @@ def _cleanup_ast(blocks):
         if warp.type != nodes.UnconditionalWarp.T_FLOW:
             continue
 
-        assert blocks.index(src) == i - 1
+        assert blocks[i - 1] == src
 
         # Move the to-be-deleted block's contents over
         src.contents += block.contents
         src.warp = block.warp
         src.last_address = block.last_address
 
-        blocks.remove(block)
+        del blocks[i]
 
         # Because we're deleting this block, we need to stay at the
         #  same index since the list moved back
@@ -88,6 +88,8 @@ WARP_TYPES = (
 
 class Visitor(traverse.Visitor):
     def __init__(self, warped=True):
+        super().__init__()
+
         # Restrictions for the upmost level
         self.restrictions = [None]
         self.warped = warped
@@ -97,6 +99,15 @@ class Visitor(traverse.Visitor):
             specific = {}
         self.restrictions[-1] = TypeRestriction(default, specific)
 
+    # A NoOp doesn't accept visitors, so it never reaches _visit_node and is
+    # checked by the list holding it instead
+    def _check_no_ops(self, contents):
+        restrictions = self.restrictions[-1]
+
+        for statement in contents:
+            if isinstance(statement, nodes.NoOp):
+                restrictions.check(statement)
+
     # ##
 
     def visit_function_definition(self, node):
@@ -177,6 +188,7 @@ class Visitor(traverse.Visitor):
             types = STATEMENT_TYPES
 
         self._set_restrictions(types)
+        self._check_no_ops(node.contents)
 
     def visit_identifiers_list(self, node):
         # HACK
@@ -250,6 +262,7 @@ class Visitor(traverse.Visitor):
         self._set_restrictions(STATEMENT_TYPES, {
             node.warp: WARP_TYPES
         })
+        self._check_no_ops(node.contents)
 
         assert node.index >= 0
 
@@ -346,7 +359,10 @@ class Visitor(traverse.Visitor):
 
     # ##
 
-    def _visit(self, node):
+    # The checks are done in _visit_node/_leave_node rather than _visit, so
+    # the validator can share a walk with other visitors
+
+    def _visit_node(self, handler, node):
         restrictions = self.restrictions[-1]
 
         if restrictions is not None:
@@ -355,7 +371,10 @@ class Visitor(traverse.Visitor):
         # Add layer for the child node
         self.restrictions.append(None)
 
-        traverse.Visitor._visit(self, node)
+        traverse.Visitor._visit_node(self, handler, node)
+
+    def _leave_node(self, handler, node):
+        traverse.Visitor._leave_node(self, handler, node)
 
         # And pop it back
         self.restrictions.pop()
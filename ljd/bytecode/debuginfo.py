@@ -2,6 +2,8 @@
 # Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
 #
 
+import array
+
 
 class VariableInfo:
     T_VISIBLE = 0
@@ -15,11 +17,49 @@ class VariableInfo:
 
 
 class DebugInformation:
+    _LAZY_FIELDS = ("addr_to_line_map", "upvalue_variable_names", "variable_info")
+
     def __init__(self):
-        self.addr_to_line_map = []
+        self._reader = None
+        self._reset()
+
+    def _reset(self):
+        self.addr_to_line_map = array.array("I")
         self.upvalue_variable_names = []
         self.variable_info = []
 
+    # Drops the fields until one of them is first used, at which point
+    # reader(self) is called to fill them in
+    def read_lazily(self, reader):
+        for name in self._LAZY_FIELDS:
+            delattr(self, name)
+
+        self._reader = reader
+
+    # Only called for missing attributes, so this costs nothing once the
+    # fields are read
+    def __getattr__(self, name):
+        reader = self.__dict__.get("_reader")
+
+        if reader is None or name not in self._LAZY_FIELDS:
+            raise AttributeError(name)
+
+        self._reset()
+
+        # Only drop the reader once it succeeded, so a failed read fails
+        # again the next time instead of leaving the fields empty
+        try:
+            reader(self)
+        except:
+            for field in self._LAZY_FIELDS:
+                delattr(self, field)
+
+            raise
+
+        self._reader = None
+
+        return getattr(self, name)
+
     def lookup_line_number(self, addr):
         try:
             return self.addr_to_line_map[addr]
@@ -2,6 +2,7 @@
 # Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
 #
 
+import math
 import re
 import sys
 import traceback
@@ -16,6 +17,10 @@ comment_empty_blocks = True
 show_slot_ids = False
 show_line_info = False
 
+# Skip structural recovery and write the block graph with labels and gotos,
+# see GotoVisitor
+goto_output = False
+
 CMD_START_STATEMENT = 0
 CMD_END_STATEMENT = 1
 CMD_END_LINE = 3
@@ -41,6 +46,28 @@ STATEMENT_WHILE = 8
 
 STATEMENT_FUNCTION = 9
 
+STATEMENT_GOTO = 10
+
+# Rendered constants, one table per constant type as 1 and 1.0 (or 0.0 and
+# -0.0) are the same key. Data files repeat the same keys and values over
+# and over, so this saves escaping and formatting them every time. A table
+# is dropped whenever it fills up.
+_LITERALS = {
+    nodes.Constant.T_INTEGER: {},
+    nodes.Constant.T_FLOAT: {},
+    nodes.Constant.T_STRING: {},
+}
+_LITERALS_LIMIT = 65536
+_CACHED_STRING_LENGTH_LIMIT = 256
+
+_STRING_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\"": "\\\"",
+})
+
 VALID_IDENTIFIER = re.compile(r'^[a-zA-Z_][\w]*$')
 
 RESERVED_WORDS = [
@@ -88,7 +115,10 @@ class Visitor(traverse.Visitor):
         self.print_queue = []
 
         self._path = []
-        self._visited_nodes = [set()]
+
+        # The ids of the nodes visited (or skipped) on each level, None until
+        # the level has any, so the leaves don't get a set of their own
+        self._visited_nodes = [None]
         self._states = [_State()]
 
         self.line_token_map = {}
@@ -197,14 +227,17 @@ class Visitor(traverse.Visitor):
 
         args = node.arguments
 
-        # If this is a method, remove the "self" argument
+        # If this is a method, leave out the "self" argument. The AST is left
+        #  alone, so the original arguments list is skipped and a trimmed copy
+        #  written in its place
         if is_method:
-            # AFAIK we don't ever use the args again, and if we
-            #  use a new args object then the original one gets written later on
-            orig = args.contents
-            args.contents = orig[1:]
+            assert args.contents[0].name == "self"
 
-            assert orig[0].name == "self"
+            self._skip(args)
+
+            method_args = nodes.IdentifiersList()
+            method_args.contents = args.contents[1:]
+            args = method_args
 
             # Same as above with function_name, set this to false afterwards
             # This is because it is only set in visit_assignment if it is a
@@ -236,12 +269,6 @@ class Visitor(traverse.Visitor):
                     self._end_line()
             self._end_block()
 
-        # Syntactic Sugar: Cull empty returns at the ends of functions
-        if len(node.statements.contents) > 1:
-            end_node = node.statements.contents[-1]
-            if isinstance(end_node, nodes.Return) and len(end_node.returns.contents) == 0:
-                node.statements.contents.pop(-1)
-
         self._visit(node.statements)
 
         self._write("end")
@@ -252,6 +279,10 @@ class Visitor(traverse.Visitor):
     # ##
 
     def visit_table_constructor(self, node):
+        if node._template is not None:
+            self._write_table_template(node._template)
+            return
+
         self._write("{")
 
         # These are both delt with in the contents array, no need to visit them separately
@@ -290,6 +321,69 @@ class Visitor(traverse.Visitor):
 
         self._write("}")
 
+    # Same output as for the records built from the template, without
+    #  building them
+    def _write_table_template(self, template):
+        self._write("{")
+
+        records = template.dictionary
+
+        if len(template.array) > 0:
+            first = template.array[0]
+            array = [(None, value) for value in template.array[1:]]
+
+            if first is not None:
+                records = [(0, first)] + array + records
+            else:
+                records = array + records
+
+        if compact_table_constructors and len(records) == 1:
+            self._write_template_record(*records[0])
+        elif len(records) > 0:
+            self._end_line()
+
+            self._start_block()
+
+            for key, value in records[:-1]:
+                self._write_template_record(key, value)
+
+                self._write(",")
+                self._end_line()
+
+            self._write_template_record(*records[-1])
+            self._end_line()
+
+            self._end_block()
+
+        self._write("}")
+
+    def _write_template_record(self, key, value):
+        if key is None:
+            pass
+        elif isinstance(key, str) and VALID_IDENTIFIER.match(key) and key not in RESERVED_WORDS:
+            self._write(key)
+            self._write(" = ")
+        else:
+            self._write("[")
+            self._write_template_value(key)
+            self._write("] = ")
+
+        self._write_template_value(value)
+
+    def _write_template_value(self, value):
+        if value is None:
+            self._write("nil")
+        elif value is True:
+            self._write("true")
+        elif value is False:
+            self._write("false")
+        elif isinstance(value, int):
+            self._write_literal(nodes.Constant.T_INTEGER, value)
+        elif isinstance(value, float):
+            self._write_literal(nodes.Constant.T_FLOAT, value)
+        else:
+            self._write_literal(nodes.Constant.T_STRING, value)
+
     def visit_table_record(self, node):
         if self._is_valid_name(node.key):
             self._write(node.key.value)
@@ -717,8 +811,17 @@ class Visitor(traverse.Visitor):
 
             self._skip(node.arguments)
         else:
+            # An inlined function definition isn't a prefix expression
+            func_is_definition = isinstance(func, nodes.FunctionDefinition)
+
+            if func_is_definition:
+                self._write("(")
+
             self._visit(node.function)
 
+            if func_is_definition:
+                self._write(")")
+
             self._write("(")
             self._visit(node.arguments)
             self._write(")")
@@ -955,30 +1058,33 @@ class Visitor(traverse.Visitor):
     # ##
 
     def visit_constant(self, node):
-        if node.type != nodes.Constant.T_STRING:
-            self._write(node.value)
-            return
+        self._write_literal(node.type, node.value)
+
+    def _write_literal(self, constant_type, value):
+        literals = _LITERALS.get(constant_type)
 
-        lines = node.value.count("\n")
+        if literals is None:
+            self._write(value)
+            return
 
-        if lines > 2:
-            self._write("[[")
+        text = literals.get(value)
 
-            self._write("\n")
+        if text is None:
+            text = _render_literal(constant_type, value)
 
-            self._write(node.value)
+            if constant_type == nodes.Constant.T_STRING:
+                cached = len(value) <= _CACHED_STRING_LENGTH_LIMIT
+            else:
+                # -0.0 would otherwise take the place of 0.0
+                cached = value != 0
 
-            self._write("]]")
-        else:
-            text = node.value
+            if cached:
+                if len(literals) >= _LITERALS_LIMIT:
+                    literals.clear()
 
-            text = text.replace("\\", "\\\\")
-            text = text.replace("\t", "\\t")
-            text = text.replace("\n", "\\n")
-            text = text.replace("\r", "\\r")
-            text = text.replace("\"", "\\\"")
+                literals[value] = text
 
-            self._write('"' + text + '"')
+        self._write(text)
 
     def visit_primitive(self, node):
         if node.type == nodes.Primitive.T_FALSE:
@@ -999,28 +1105,37 @@ class Visitor(traverse.Visitor):
         traverse.Visitor._leave_node(self, handler, node)
 
     def _skip(self, node):
-        self._visited_nodes[-1].add(node)
+        visited = self._visited_nodes[-1]
+
+        if visited is None:
+            self._visited_nodes[-1] = {id(node)}
+        else:
+            visited.add(id(node))
 
     def _visit(self, node):
         assert node is not None
 
-        if node in self._visited_nodes[-1]:
-            return
+        visited = self._visited_nodes[-1]
 
-        self._visited_nodes[-1].add(node)
+        if visited is None:
+            self._visited_nodes[-1] = {id(node)}
+        elif id(node) in visited:
+            return
+        else:
+            visited.add(id(node))
 
         # TODO: add check
         # "It looks like you forgot about some node changes..."
 
-        self._visited_nodes.append(set())
+        self._visited_nodes.append(None)
 
-        if hasattr(node, "_decompilation_error_here"):
+        if node._decompilation_error_here:
             self._end_line()
             self._write("-- Decompilation error in this vicinity:")
             self._end_line()
 
-        if hasattr(node, "_line") and node._line:
-            line = node._line
+        line = node._line
+        if line:
             self.line_token_map[line] = len(self.print_queue)
 
         traverse.Visitor._visit(self, node)
@@ -1028,10 +1143,864 @@ class Visitor(traverse.Visitor):
         self._visited_nodes.pop()
 
 
+def _render_literal(constant_type, value):
+    if constant_type != nodes.Constant.T_STRING:
+        return str(value)
+
+    if value.count("\n") > 2:
+        return "[[\n" + value + "]]"
+
+    return '"' + value.translate(_STRING_ESCAPES) + '"'
+
+
+# Per function naming and layout for the goto output
+class _GotoFunction:
+    def __init__(self, node, parent):
+        self.node = node
+        self.parent = parent
+
+        # Debug names seen for each slot used in the function
+        self.slots = {}
+
+        # Rendered name of each slot and each upvalue
+        self.names = {}
+        self.upvalue_names = []
+
+        # Blocks in output order, and the ones somebody jumps to
+        self.positions = {}
+        self.labels = set()
+
+        # Holds the tested value of an ISTC/ISFC-style warp, when the value
+        #  is an expression that can't be evaluated twice
+        self.test_name = None
+        self.needs_test = False
+
+        # Where the closures capture each local, as the (position, address)
+        #  of the statement they are written in
+        self.captures = {}
+        self.block = None
+        self.addr = -1
+
+        # The do ... end blocks redeclaring the captured locals (see
+        #  _find_goto_scopes), and the UCLO each block ends with, if any
+        self.scopes = []
+        self.closes = {}
+        self.shares_captures = False
+
+    def add_slot(self, slot, name=None):
+        names = self.slots.setdefault(slot, set())
+
+        if name:
+            names.add(name)
+
+
+class _GotoCollector(traverse.Visitor):
+    def __init__(self):
+        super().__init__()
+
+        self.functions = []
+        self.owners = {}
+        self.global_names = set()
+
+        self._functions = []
+
+    def visit_function_definition(self, node):
+        parent = self._functions[-1] if self._functions else None
+
+        if parent is not None and parent.block is not None:
+            capture = parent.positions[parent.block], parent.addr
+
+            for reference in node._upvalues or []:
+                if reference & _UV_LOCAL:
+                    parent.captures.setdefault(reference & 0xff, []).append(capture)
+
+        # Only the functions which are still warped are written with goto,
+        #  the unwarper might have been through the others
+        contents = node.statements.contents
+
+        if not contents or not isinstance(contents[0], nodes.Block):
+            self._functions.append(None)
+            return
+
+        function = _GotoFunction(node, parent)
+
+        # Make sure the captured locals get a name in the parent
+        for reference in node._upvalues or []:
+            if parent is not None and reference & _UV_LOCAL:
+                parent.add_slot(reference & 0xff)
+
+        self.functions.append(function)
+        self.owners[node] = function
+        self._functions.append(function)
+
+    def leave_function_definition(self, node):
+        self._functions.pop()
+
+    def visit_statements_list(self, node):
+        function = self._functions[-1]
+
+        if function is None or node is not function.node.statements:
+            return
+
+        self.owners[node] = function
+
+        for i, block in enumerate(node.contents):
+            if not isinstance(block, nodes.Block):
+                continue
+
+            function.positions[block] = i
+            self.owners[block] = function
+
+            targets = _get_warp_targets(block.warp)
+            function.labels.update(target for target in targets if target is not None)
+
+    def visit_conditional_warp(self, node):
+        slot = getattr(node, "_slot", -1)
+
+        if 0 <= slot < SLOT_FALSE:
+            function = self._functions[-1]
+            function.add_slot(slot)
+
+            if not isinstance(_get_tested_value(node), nodes.Identifier):
+                function.needs_test = True
+
+    def visit_numeric_loop_warp(self, node):
+        base = node.index.slot - 3
+
+        for slot in range(base, base + 3):
+            self._functions[-1].add_slot(slot)
+
+    def visit_iterator_warp(self, node):
+        base = node.variables.contents[0].slot
+
+        for slot in range(base - 3, base):
+            self._functions[-1].add_slot(slot)
+
+    def visit_return(self, node):
+        function = self._functions[-1]
+
+        if function is not None:
+            self.owners[node] = function
+
+    def visit_break(self, node):
+        function = self._functions[-1]
+        target = getattr(node, "_target", None)
+
+        if function is not None and target is not None:
+            function.labels.add(target)
+
+    def visit_identifier(self, node):
+        function = self._functions[-1]
+
+        if function is None:
+            return
+
+        if node.type in (nodes.Identifier.T_SLOT, nodes.Identifier.T_LOCAL):
+            if node.slot >= SLOT_FALSE:
+                return
+
+            name = node.name if node.type == nodes.Identifier.T_LOCAL else None
+            function.add_slot(node.slot, name)
+
+        self.owners[node] = function
+
+    def visit_table_element(self, node):
+        if Visitor._is_builtin(node.table) and Visitor._is_valid_name(node.key):
+            self.global_names.add(node.key.value)
+
+    def visit_block(self, node):
+        function = self._functions[-1]
+
+        if function is not None and node in function.positions:
+            function.block = node
+
+    # Keeps the address of the statement (or warp) being visited, for the
+    #  closures in it
+    def _visit_list(self, nodes_list):
+        function = self._functions[-1] if self._functions else None
+
+        if function is None or function.block is None or nodes_list is not function.block.contents:
+            traverse.Visitor._visit_list(self, nodes_list)
+            return
+
+        block = function.block
+
+        for statement in nodes_list:
+            function.addr = getattr(statement, "_addr", -1)
+            self._visit(statement)
+
+        function.addr = getattr(block.warp, "_addr", -1)
+
+
+# Flag of an upvalue reference to a local of the parent function
+_UV_LOCAL = 0x8000
+
+
+def _get_warp_targets(warp):
+    if isinstance(warp, nodes.UnconditionalWarp):
+        return [warp.target]
+    elif isinstance(warp, nodes.ConditionalWarp):
+        return [warp.true_target, warp.false_target]
+    elif isinstance(warp, (nodes.IteratorWarp, nodes.NumericLoopWarp)):
+        return [warp.body, warp.way_out]
+    else:
+        return []
+
+
+def _get_tested_value(warp):
+    condition = warp.condition
+
+    if isinstance(condition, nodes.UnaryOperator) and condition.type == nodes.UnaryOperator.T_NOT:
+        return condition.operand
+
+    return condition
+
+
+def _name_goto_function(function, global_names):
+    node = function.node
+    parent = function.parent
+
+    for i, reference in enumerate(node._upvalues or []):
+        if parent is None:
+            # Same as the rest of the writer, for the functions nested in an
+            #  unwarped one
+            name = node._debuginfo and node._debuginfo.lookup_upvalue_name(i) or "uv{0}".format(i)
+        elif reference & _UV_LOCAL:
+            name = parent.names[reference & 0xff]
+        else:
+            name = parent.upvalue_names[reference & 0x3fff]
+
+        function.upvalue_names.append(name)
+
+    # Every local is declared at the top of the function, so the names have
+    # to be unique and must not hide any upvalue or global the code uses
+    taken = set(function.upvalue_names) | global_names
+
+    def free_name(base):
+        name = base
+        i = 1
+
+        while name in taken:
+            name = "{0}_{1}".format(base, i)
+            i += 1
+
+        taken.add(name)
+        return name
+
+    fallback = []
+
+    for slot in sorted(function.slots):
+        names = function.slots[slot]
+
+        if len(names) == 1:
+            name = next(iter(names))
+
+            if VALID_IDENTIFIER.match(name) and name not in RESERVED_WORDS and name not in taken:
+                taken.add(name)
+                function.names[slot] = name
+                continue
+
+        fallback.append(slot)
+
+    for slot in fallback:
+        function.names[slot] = free_name("slot{0}".format(slot))
+
+    if function.needs_test:
+        function.test_name = free_name("test")
+
+
+# A do ... end of the goto output, declaring the captured locals again
+class _GotoScope:
+    def __init__(self, slots, first_block, start_addr, last_block, end_addr):
+        self.slots = slots
+
+        # Covers the statements of first_block after start_addr (all of them
+        #  for -1), the blocks in between and the statements of last_block up
+        #  to end_addr. The warp of last_block is left out.
+        self.first_block = first_block
+        self.start_addr = start_addr
+        self.last_block = last_block
+        self.end_addr = end_addr
+
+        # Suffix of the label right after the declarations, for the jumps
+        #  back to the start which don't leave the scope
+        self.label = None
+
+
+# The jumps the goto output makes out of a block
+def _get_jump_targets(block):
+    last = block.contents[-1] if block.contents else None
+
+    # The warp isn't written after those
+    if isinstance(last, nodes.Return):
+        return []
+    elif isinstance(last, nodes.Break):
+        return [getattr(last, "_target", None)]
+
+    return _get_warp_targets(block.warp)
+
+
+# All the locals are declared at the top of a goto function, but closures
+# have to get new variables each time the scope they capture a local in is
+# entered. So the code from there to the UCLO closing the local is written
+# in a do ... end, declaring the local again with its current value.
+#
+# Such a block can only be entered at its start, and can only be left by a
+# jump closing the local (or a return), as the value of the inner variable
+# is lost. It is grown backwards from the UCLO for as long as that holds.
+#
+# Any closure which can't be given its own variable this way gets the
+# function flagged with shares_captures.
+def _find_goto_scopes(function):
+    blocks = function.node.statements.contents
+    positions = function.positions
+
+    jumps = []
+    sources = [[] for _ in blocks]
+    splits = []
+    closes = []
+
+    for position, block in enumerate(blocks):
+        uclos = sorted(getattr(block, "_uclos", ()))
+        last_addr = max((getattr(statement, "_addr", -1) for statement in block.contents), default=-1)
+
+        # The UCLO a return is compiled with doesn't matter, everything is
+        #  left anyway
+        if block.contents and isinstance(block.contents[-1], nodes.Return):
+            returned_addr = max((getattr(statement, "_addr", -1) for statement in block.contents[:-1]), default=-1)
+            uclos = [uclo for uclo in uclos if uclo[0] < returned_addr]
+
+        # A UCLO after the statements closes the upvalues for all the jumps
+        #  out of the block, any other one splits it
+        close = None
+        if uclos and uclos[-1][0] >= last_addr:
+            close = uclos.pop()
+
+        targets = [positions[target] for target in _get_jump_targets(block) if target in positions]
+
+        for target in targets:
+            sources[target].append(position)
+
+        jumps.append(targets)
+        splits.append(uclos)
+        closes.append(close)
+
+        if close is not None:
+            function.closes[block] = close[1]
+
+    def is_closing(position, slot):
+        close = closes[position]
+        return close is not None and close[1] <= slot
+
+    # Entered at the next iteration label from inside the loop, which would
+    #  be inside the scope
+    def is_loop_entered(first, last, slot):
+        warp = blocks[first].warp
+
+        if not isinstance(warp, (nodes.NumericLoopWarp, nodes.IteratorWarp)):
+            return False
+
+        way_out = positions.get(warp.way_out, -1)
+
+        for source in sources[first]:
+            if first < source < way_out and (source >= last or is_closing(source, slot)):
+                return True
+
+        return False
+
+    # The (position, address) the scope closed by the UCLO at end_addr in
+    #  the block at last starts at
+    def grow(slot, last, end_addr):
+        earlier = [addr for addr, first_slot in splits[last] if first_slot <= slot and addr < end_addr]
+
+        if earlier:
+            return last, earlier[-1]
+
+        start = last, -1
+
+        # A closing jump to last doesn't need the value either when nothing
+        #  runs there before the UCLO, it's as good as leaving
+        empty_end = not any(getattr(statement, "_addr", -1) < end_addr for statement in blocks[last].contents)
+
+        lowest_source = len(blocks)
+        lowest_target = len(blocks)
+        highest_closing = -1
+
+        for first in range(last - 1, -1, -1):
+            # Jumps into the scope past its start, the ones from the warp of
+            #  last can't be taken in
+            for source in sources[first + 1]:
+                if source >= last:
+                    return start
+
+                lowest_source = min(lowest_source, source)
+
+            closing = is_closing(first, slot)
+
+            for target in jumps[first]:
+                if closing:
+                    if target < last or target == last and not empty_end:
+                        highest_closing = max(highest_closing, target)
+                elif target > last:
+                    return start
+                else:
+                    lowest_target = min(lowest_target, target)
+
+            # Closing without leaving the scope
+            if highest_closing > first:
+                return start
+
+            earlier = [addr for addr, first_slot in splits[first] if first_slot <= slot]
+
+            if earlier:
+                if lowest_source > first and lowest_target > first:
+                    start = first, earlier[-1]
+
+                return start
+
+            if lowest_source >= first and lowest_target >= first and not is_loop_entered(first, last, slot):
+                start = first, -1
+
+        return start
+
+    found = {}
+
+    for slot, captures in function.captures.items():
+        for last, uclos in enumerate(splits):
+            ends = [addr for addr, first_slot in uclos if first_slot <= slot]
+
+            if is_closing(last, slot):
+                ends.append(closes[last][0])
+
+            for end_addr in ends:
+                start = grow(slot, last, end_addr)
+                end = last, end_addr
+
+                if any(start < capture <= end for capture in captures):
+                    found.setdefault((start, end), set()).add(slot)
+
+    # Outer scopes first. The ones overlapping another are dropped.
+    ordered = sorted(found.items(), key=lambda item: (item[0][0], -item[0][1][0], -item[0][1][1]))
+
+    kept = []
+    enclosing = []
+
+    for (start, end), slots in ordered:
+        while enclosing and enclosing[-1][1] <= start:
+            enclosing.pop()
+
+        if enclosing and end > enclosing[-1][1]:
+            continue
+
+        enclosing.append((start, end))
+        kept.append((start, end, slots))
+
+    for start, end, slots in kept:
+        first, start_addr = start
+        last, end_addr = end
+
+        scope = _GotoScope(sorted(slots), blocks[first], start_addr, blocks[last], end_addr)
+
+        # The jumps back to the start from inside the scope that keep the
+        #  variables go to the label after the declarations
+        if start_addr < 0:
+            for source in sources[first]:
+                if first <= source < last and not is_closing(source, min(slots)):
+                    scope.label = "_in{0}".format(len(function.scopes))
+                    break
+
+        function.scopes.append(scope)
+
+    for slot, captures in function.captures.items():
+        uncovered = [capture for capture in captures
+                     if not any(slot in slots and start < capture <= end for start, end, slots in kept)]
+
+        if not uncovered:
+            continue
+
+        # The blocks from which a UCLO closing the local can be reached
+        reached = [position for position in range(len(blocks))
+                   if is_closing(position, slot) or any(first_slot <= slot for _, first_slot in splits[position])]
+        reached = set(reached)
+        queue = list(reached)
+
+        while queue:
+            for source in sources[queue.pop()]:
+                if source not in reached:
+                    reached.add(source)
+                    queue.append(source)
+
+        for position, addr in uncovered:
+            later = any(uclo_addr > addr and first_slot <= slot for uclo_addr, first_slot in splits[position])
+
+            if later or is_closing(position, slot) or any(target in reached for target in jumps[position]):
+                function.shares_captures = True
+
+
+# Writes the warped AST as it is, each block getting a label and each warp
+# becoming a goto. This skips the unwarper entirely, so it always works and
+# takes linear time, at the cost of readability.
+#
+# All the locals of a function are declared at its top, named by slot, as a
+# goto can't jump into the scope of a local. The locals captured by closures
+# are declared again in do ... end blocks, see _find_goto_scopes.
+class GotoVisitor(Visitor):
+    def __init__(self, ast):
+        super().__init__()
+
+        collector = _GotoCollector()
+        traverse.traverse(collector, ast)
+
+        for function in collector.functions:
+            _name_goto_function(function, collector.global_names)
+            _find_goto_scopes(function)
+
+        self._owners = collector.owners
+
+        # The scopes currently open, innermost last, and the block being written
+        self._scopes = []
+        self._block = None
+
+    # ##
+
+    def visit_statements_list(self, node):
+        super().visit_statements_list(node)
+
+        function = self._owners.get(node)
+
+        if function is None:
+            return
+
+        arguments = set()
+        for argument in function.node.arguments.contents:
+            if isinstance(argument, nodes.Identifier):
+                arguments.add(argument.slot)
+
+        declared = [name for slot, name in sorted(function.names.items()) if slot not in arguments]
+
+        if function.test_name is not None:
+            declared.append(function.test_name)
+
+        if declared:
+            self._write("local " + ", ".join(declared))
+            self._end_line()
+            self._end_line()
+
+    def visit_block(self, node):
+        function = self._owners[node]
+
+        if node in function.labels:
+            self._write_label(node)
+
+        starts = [scope for scope in function.scopes if scope.first_block is node]
+
+        self._update_scopes(node, starts, 0)
+
+        for statement in node.contents:
+            addr = getattr(statement, "_addr", None)
+
+            if addr is not None:
+                self._update_scopes(node, starts, addr)
+
+            self._block = node
+            self._visit(statement)
+
+        self._update_scopes(node, starts, math.inf)
+
+        warp = node.warp
+
+        # Nothing runs after a return or a break, and the target of the jump
+        #  might not even be visible from there
+        last = node.contents[-1] if node.contents else None
+        reachable = not isinstance(last, (nodes.Return, nodes.Break))
+
+        if reachable and isinstance(warp, nodes.UnconditionalWarp):
+            self._write_unconditional_goto(node, warp)
+        elif reachable and isinstance(warp, nodes.ConditionalWarp):
+            self._write_conditional_goto(node, warp)
+        elif isinstance(warp, nodes.NumericLoopWarp):
+            self._write_numeric_loop(node, warp)
+        elif isinstance(warp, nodes.IteratorWarp):
+            self._write_iterator_loop(node, warp)
+
+        if warp is not None:
+            self._skip(warp)
+
+    # Closes the scopes of the block which end before addr, then opens the
+    #  ones starting before it
+    def _update_scopes(self, block, starts, addr):
+        function = self._owners[block]
+
+        while self._scopes and self._scopes[-1].last_block is block and self._scopes[-1].end_addr < addr:
+            self._scopes.pop()
+
+            self._pop_state()
+            self._end_block()
+
+            self._write("end")
+            self._end_statement(STATEMENT_GOTO)
+
+        while starts and starts[0].start_addr < addr:
+            scope = starts.pop(0)
+
+            # Spaced out like the gotos
+            self._start_statement(STATEMENT_GOTO)
+            self._write("do")
+            self._end_line()
+
+            self._start_block()
+            self._push_state()
+
+            self._write("local {0} = {0}".format(", ".join(function.names[slot] for slot in scope.slots)))
+            self._end_line()
+
+            if scope.label is not None:
+                self._write_label(block, scope.label)
+
+            self._scopes.append(scope)
+
+    def _get_label(self, block, suffix=""):
+        function = self._owners[block]
+        return "b{0}{1}".format(function.positions[block], suffix)
+
+    def _write_label(self, block, suffix=""):
+        self._write("::" + self._get_label(block, suffix) + "::")
+        self._end_line()
+
+    # The target label of a jump. A jump back into a loop from its body goes
+    #  to the next iteration, the contents of the loop block only run once.
+    def _get_target(self, source, target):
+        function = self._owners[source]
+        warp = target.warp
+
+        if isinstance(warp, (nodes.NumericLoopWarp, nodes.IteratorWarp)):
+            position = function.positions[source]
+
+            if function.positions[target] < position < function.positions.get(warp.way_out, -1):
+                return self._get_label(target, "_next")
+
+        # Staying in a scope which starts at the target keeps its variables
+        close = function.closes.get(source)
+
+        for scope in reversed(self._scopes):
+            if scope.first_block is target and scope.label is not None \
+                    and (close is None or close > scope.slots[0]):
+                return self._get_label(target, scope.label)
+
+        return self._get_label(target)
+
+    # A jump to the block right after this one can be left out
+    def _write_goto(self, source, target):
+        if target is None:
+            return
+
+        label = self._get_target(source, target)
+
+        function = self._owners[source]
+        if label == self._get_label(target) and function.positions[target] == function.positions[source] + 1:
+            return
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("goto " + label)
+        self._end_statement(STATEMENT_GOTO)
+
+    def _write_unconditional_goto(self, block, warp):
+        self._write_goto(block, warp.target)
+
+    def _write_conditional_goto(self, block, warp):
+        function = self._owners[block]
+        slot = getattr(warp, "_slot", -1)
+
+        # ISTC and ISFC also copy the tested value into _slot, but only when
+        #  jumping, which is the false branch
+        value = _get_tested_value(warp)
+        copied = 0 <= slot < SLOT_FALSE and not (isinstance(value, nodes.Identifier) and value.slot == slot)
+
+        # Anything but a variable is evaluated once, up front
+        test_name = None
+        if copied and not isinstance(value, nodes.Identifier):
+            test_name = function.test_name
+
+            self._start_statement(STATEMENT_GOTO)
+            self._write(test_name + " = ")
+            self._visit(value)
+            self._end_statement(STATEMENT_GOTO)
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("if ")
+
+        if test_name is None:
+            self._visit(warp.condition)
+        elif warp.condition is value:
+            self._write(test_name)
+        else:
+            self._write("not " + test_name)
+
+        self._write(" then goto " + self._get_target(block, warp.true_target) + " end")
+        self._end_statement(STATEMENT_GOTO)
+
+        if copied:
+            self._start_statement(STATEMENT_GOTO)
+            self._write(function.names[slot] + " = " + (test_name or self._get_name(value)))
+            self._end_statement(STATEMENT_GOTO)
+
+        self._write_goto(block, warp.false_target)
+
+    def _write_numeric_loop(self, block, warp):
+        function = self._owners[block]
+        base = warp.index.slot - 3
+
+        index, limit, step = [function.names[slot] for slot in range(base, base + 3)]
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("{0}, {1}, {2} = ".format(index, limit, step))
+        self._visit(warp.controls)
+        self._end_statement(STATEMENT_GOTO)
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("goto " + self._get_label(block, "_test"))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._write_label(block, "_next")
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("{0} = {0} + {1}".format(index, step))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._write_label(block, "_test")
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("if {2} >= 0 and {0} <= {1} or {2} < 0 and {0} >= {1} then ".format(index, limit, step))
+        self._write("{0} = {1} goto {2} end".format(self._get_name(warp.index), index,
+                                                    self._get_target(block, warp.body)))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._write_goto(block, warp.way_out)
+
+    def _write_iterator_loop(self, block, warp):
+        function = self._owners[block]
+        base = warp.variables.contents[0].slot
+
+        generator, state, control = [function.names[slot] for slot in range(base - 3, base)]
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("{0}, {1}, {2} = ".format(generator, state, control))
+        self._visit(warp.controls)
+        self._end_statement(STATEMENT_GOTO)
+
+        self._write_label(block, "_next")
+
+        variables = [self._get_name(variable) for variable in warp.variables.contents]
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("{0} = {1}({2}, {3})".format(", ".join(variables), generator, state, control))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("if {0} == nil then goto {1} end".format(variables[0], self._get_target(block, warp.way_out)))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("{0} = {1}".format(control, variables[0]))
+        self._end_statement(STATEMENT_GOTO)
+
+        self._write_goto(block, warp.body)
+
+    # ##
+
+    def visit_return(self, node):
+        if node not in self._owners:
+            super().visit_return(node)
+            return
+
+        # A return has to be the last statement of a block, and there might
+        #  be a label after this one
+        self._start_statement(STATEMENT_RETURN)
+
+        if len(node.returns.contents) > 0:
+            self._write("do return ")
+        else:
+            self._write("do return")
+
+        self._visit(node.returns)
+
+        self._write(" end")
+
+        self._end_statement(STATEMENT_RETURN)
+
+    def visit_break(self, node):
+        target = getattr(node, "_target", None)
+
+        if target not in self._owners:
+            super().visit_break(node)
+            return
+
+        self._start_statement(STATEMENT_GOTO)
+        self._write("goto " + self._get_target(self._block, target))
+        self._end_statement(STATEMENT_GOTO)
+
+    def visit_identifier(self, node):
+        name = self._get_name(node)
+
+        if name is None:
+            super().visit_identifier(node)
+        else:
+            self._write(name)
+
+    # The name of a local or upvalue in the goto output, None for anything
+    #  written as usual
+    def _get_name(self, node):
+        function = self._owners.get(node)
+
+        if function is None or node.type == nodes.Identifier.T_BUILTIN:
+            return None
+        elif node.type == nodes.Identifier.T_UPVALUE:
+            return function.upvalue_names[node.slot]
+        elif node.slot == SLOT_FALSE:
+            return "false"
+        elif node.slot == SLOT_TRUE:
+            return "true"
+        else:
+            return function.names[node.slot]
+
+    def _is_method(self, dst, func):
+        if not super()._is_method(dst, func):
+            return False
+
+        function = self._owners.get(func)
+
+        if function is None:
+            return True
+
+        # The body has to call the first argument self for the sugar to work
+        return function.names[func.arguments.contents[0].slot] == "self"
+
+
+# The functions to be written with goto in which some closures would still
+# share the locals they capture, see _find_goto_scopes
+def find_shared_captures(ast):
+    collector = _GotoCollector()
+    traverse.traverse(collector, ast)
+
+    shared = []
+
+    for function in collector.functions:
+        _find_goto_scopes(function)
+
+        if function.shares_captures:
+            shared.append(function.node)
+
+    return shared
+
+
 def write(fd, ast, generate_linemap=False):
     assert isinstance(ast, nodes.FunctionDefinition)
 
-    visitor = Visitor()
+    # Functions the unwarper gave up on are left warped
+    if goto_output or getattr(ast, "_warped_functions", None):
+        visitor = GotoVisitor(ast)
+    else:
+        visitor = Visitor()
 
     traverse.traverse(visitor, ast.statements)
 
@@ -2,10 +2,11 @@
 # Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
 #
 
+import array
 import struct
-import sys
 
 import ljd.bytecode.constants
+import ljd.util.binstream
 
 BCDUMP_KGC_CHILD = 0
 BCDUMP_KGC_TAB = 1
@@ -21,6 +22,18 @@ BCDUMP_KTAB_INT = 3
 BCDUMP_KTAB_NUM = 4
 BCDUMP_KTAB_STR = 5
 
+# The low word comes first in memory on both little and big endian hosts
+_WORDS = struct.Struct("=II")
+_DOUBLE = struct.Struct("=d")
+
+# Decoded string constants by their raw bytes, shared by all the files read
+# in a run. Names like "self" and common field names repeat in every
+# prototype, so this saves decoding them again and keeps a single copy of
+# each. The table is dropped whenever it fills up.
+_STRINGS = {}
+_STRINGS_LIMIT = 65536
+_INTERNED_LENGTH_LIMIT = 256
+
 
 def read(parser, constants):
     r = True
@@ -54,7 +67,7 @@ def _read_complex_constants(parser, complex_constants):
 
             string = parser.stream.read_bytes(length)
 
-            complex_constants.append(string.decode("utf-8", "backslashreplace"))
+            complex_constants.append(_decode_string(string))
         elif constant_type == BCDUMP_KGC_TAB:
             table = ljd.bytecode.constants.Table()
 
@@ -78,22 +91,42 @@ def _read_complex_constants(parser, complex_constants):
     return True
 
 
+# The numeric constants take up the rest of the prototype up to the debug
+# information, so they're read and decoded in one go
 def _read_numeric_constants(parser, numeric_constants):
+    if parser.numeric_constants_count == 0:
+        return True
+
+    size = parser.end_pos - parser.debuginfo_size - parser.stream.pos
+    values = ljd.util.binstream.BinStream.decode_uleb128_values(parser.stream.read_bytes(size))
+
+    assert len(values) >= parser.numeric_constants_count
+
+    # The (lo, hi) words of the floating point constants and their indices
+    words = array.array("I")
+    number_indices = []
+
     i = 0
 
-    while i < parser.numeric_constants_count:
-        isnum, lo = parser.stream.read_uleb128_from33bit()
+    while len(numeric_constants) < parser.numeric_constants_count:
+        value = values[i]
+        i += 1
 
-        if isnum:
-            hi = parser.stream.read_uleb128()
+        # 33 bit value, with the flag in the lowest bit
+        if value & 1:
+            words.append(value >> 1)
+            words.append(values[i])
+            i += 1
 
-            number = _assemble_number(lo, hi)
+            number_indices.append(len(numeric_constants))
+            numeric_constants.append(None)
         else:
-            number = _process_sign(lo)
+            numeric_constants.append(_process_sign(value >> 1))
 
-        numeric_constants.append(number)
+    assert i == len(values), "Incorrectly read numeric constants"
 
-        i += 1
+    for index, number in zip(number_indices, _assemble_numbers(words)):
+        numeric_constants[index] = number
 
     return True
 
@@ -112,13 +145,12 @@ def _read_signed_int(parser):
 
 
 def _assemble_number(lo, hi):
-    if sys.byteorder == 'big':
-        float_as_int = lo << 32 | hi
-    else:
-        float_as_int = hi << 32 | lo
+    return _DOUBLE.unpack(_WORDS.pack(lo, hi))[0]
+
 
-    raw_bytes = struct.pack("=Q", float_as_int)
-    return struct.unpack("=d", raw_bytes)[0]
+# Converts a flat array of (lo, hi) words into floating point numbers
+def _assemble_numbers(words):
+    return array.array("d", words.tobytes())
 
 
 def _process_sign(number):
@@ -156,7 +188,7 @@ def _read_table_item(parser):
     if data_type >= BCDUMP_KTAB_STR:
         length = data_type - BCDUMP_KTAB_STR
 
-        return parser.stream.read_bytes(length).decode("utf-8", "backslashreplace")
+        return _decode_string(parser.stream.read_bytes(length))
 
     elif data_type == BCDUMP_KTAB_INT:
         return _read_signed_int(parser)
@@ -174,3 +206,18 @@ def _read_table_item(parser):
         assert data_type == BCDUMP_KTAB_NIL
 
         return None
+
+
+def _decode_string(data):
+    string = _STRINGS.get(data)
+
+    if string is None:
+        string = data.decode("utf-8", "backslashreplace")
+
+        if len(data) <= _INTERNED_LENGTH_LIMIT:
+            if len(_STRINGS) >= _STRINGS_LIMIT:
+                _STRINGS.clear()
+
+            _STRINGS[data] = string
+
+    return string
@@ -5,6 +5,7 @@
 import sys
 
 import ljd.bytecode.debuginfo
+import ljd.util.binstream
 
 VARNAME_END = 0
 VARNAME_FOR_IDX = 1
@@ -26,6 +27,37 @@ INTERNAL_VARNAMES = [
 ]
 
 
+class _State:
+    def __init__(self, parser):
+        self.stream = ljd.util.binstream.BinStream()
+        self.stream.name = parser.stream.name
+        self.stream.data_byteorder = parser.stream.data_byteorder
+
+        self.instructions_count = parser.instructions_count
+        self.upvalues_count = parser.upvalues_count
+        self.lines_count = parser.lines_count
+
+
+# Only skips over the debug information, keeping a view of it in the
+# stream's buffer. It's decoded once something first uses it.
+def read_lazily(parser, line_offset, debuginfo):
+    state = _State(parser)
+    data = parser.stream.skip_bytes_view(parser.debuginfo_size)
+
+    def reader(debuginfo):
+        state.stream.open_bytes(data, state.stream.name)
+
+        read(state, line_offset, debuginfo)
+
+        assert state.stream.eof(), \
+            "Incorrectly read debug information: {0} of {1} bytes" \
+            .format(state.stream.pos, state.stream.size)
+
+    debuginfo.read_lazily(reader)
+
+    return True
+
+
 def read(parser, line_offset, debuginfo):
     r = True
 
@@ -36,7 +68,9 @@ def read(parser, line_offset, debuginfo):
     return r
 
 
-def _read_lineinfo(parser, line_offset, lineinfo):
+# Reads the line numbers of the instructions, relative to the first line of
+# the prototype. This is the first part of the debug information.
+def read_line_numbers(parser):
     if parser.lines_count >= 65536:
         lineinfo_size = 4
     elif parser.lines_count >= 256:
@@ -44,11 +78,18 @@ def _read_lineinfo(parser, line_offset, lineinfo):
     else:
         lineinfo_size = 1
 
+    return parser.stream.read_uint_array(parser.instructions_count, lineinfo_size)
+
+
+def _read_lineinfo(parser, line_offset, lineinfo):
+    line_numbers = read_line_numbers(parser)
+
     lineinfo.append(0)
 
-    while len(lineinfo) < parser.instructions_count + 1:
-        line_number = parser.stream.read_uint(lineinfo_size)
-        lineinfo.append(line_offset + line_number)
+    if line_offset != 0:
+        lineinfo.extend(map(line_offset.__add__, line_numbers))
+    else:
+        lineinfo.fromlist(line_numbers.tolist())
 
     return True
 
@@ -0,0 +1,226 @@
+#
+# Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
+#
+
+import ljd.bytecode.constants
+import ljd.bytecode.instructions as ins
+import ljd.bytecode.prototype
+import ljd.rawdump.constants
+import ljd.rawdump.debuginfo
+import ljd.rawdump.header
+import ljd.rawdump.prototype
+import ljd.util.binstream
+from ljd.rawdump.luajit.v2_0.luajit_opcode import _OPCODES as _OPCODES_2_0
+from ljd.rawdump.luajit.v2_1.luajit_opcode import _OPCODES as _OPCODES_2_1
+
+# Fields of the records returned by extract(), in output order
+FIELDS = (
+    "file",
+    "prototype",
+    "index",
+    "type",
+    "value",
+    "addresses",
+    "lines",
+    "error"
+)
+
+# Bytecode version to the operand masks of the instructions referencing a
+# string or a table constant, built on first use
+_CONSTANT_OPERANDS = {}
+
+
+class _State:
+    def __init__(self):
+        self.stream = ljd.util.binstream.BinStream()
+        self.flags = ljd.rawdump.header.Flags()
+        self.header = None
+        self.prototypes = []
+        self.constant_operands = None
+
+
+class _Prototype:
+    def __init__(self):
+        self.constants = ljd.bytecode.constants.Constants()
+
+        # Constant operand index to the addresses and the lines of the
+        # instructions referencing it
+        self.addresses = {}
+        self.lines = {}
+        self.has_lines = False
+
+
+# Extracts the string and table constants of a bytecode file, along with
+# the instructions (and lines, if there's debug information) referencing
+# them. Only the constants and the line information
+# are decoded, the instructions are only checked for their constant
+# operands and everything else is skipped over.
+def extract(filename):
+    parser = _State()
+
+    try:
+        parser.stream.open(filename)
+    except OSError as e:
+        return [_error_record(filename, str(e))]
+
+    try:
+        error = _read_header(parser)
+
+        if error is None:
+            error = _read_prototypes(parser)
+    except IOError as e:
+        error = str(e)
+    finally:
+        parser.stream.close()
+
+    if error is not None:
+        return [_error_record(filename, error)]
+
+    if len(parser.prototypes) != 1:
+        return [_error_record(filename, "Invalid prototypes stack order")]
+
+    records = []
+
+    _collect_records(filename, parser.prototypes[0], "main", records)
+
+    return records
+
+
+def _error_record(filename, error):
+    record = dict.fromkeys(FIELDS)
+    record["file"] = filename
+    record["error"] = error
+
+    return record
+
+
+def _read_header(parser):
+    header = ljd.rawdump.header.Header()
+
+    if not ljd.rawdump.header.read(parser, header):
+        return "Invalid header"
+
+    if header.version == 1:
+        opcodes = _OPCODES_2_0
+    elif header.version == 2:
+        opcodes = _OPCODES_2_1
+    else:
+        return "Unsupported bytecode version: " + str(header.version)
+
+    if header.flags.is_big_endian:
+        parser.stream.data_byteorder = 'big'
+    else:
+        parser.stream.data_byteorder = 'little'
+
+    parser.header = header
+    parser.constant_operands = _get_constant_operands(header.version, opcodes)
+
+    return None
+
+
+def _get_constant_operands(version, opcodes):
+    operands = _CONSTANT_OPERANDS.get(version)
+
+    if operands is None:
+        operands = [0] * 256
+
+        for opcode, definition in opcodes:
+            if definition.CD_type in (ins.T_STR, ins.T_TAB):
+                operands[opcode] = 0xFF if definition.args_count == 3 else 0xFFFF
+
+        _CONSTANT_OPERANDS[version] = operands
+
+    return operands
+
+
+def _read_prototypes(parser):
+    while not parser.stream.eof():
+        prototype = _Prototype()
+
+        head = ljd.bytecode.prototype.Prototype()
+        state = ljd.rawdump.prototype.read_head(parser, head)
+
+        if state is None:
+            if parser.stream.eof():
+                break
+            else:
+                return "Failed to read prototype"
+
+        _read_prototype(state, head.first_line_number, prototype)
+
+        parser.prototypes.append(prototype)
+
+    return None
+
+
+def _read_prototype(state, first_line_number, prototype):
+    stream = state.stream
+    operands = state.constant_operands
+
+    codewords = stream.read_uint_array(state.instructions_count, 4)
+
+    references = []
+
+    for addr, codeword in enumerate(codewords, 1):
+        mask = operands[codeword & 0xFF]
+
+        if mask:
+            references.append(((codeword >> 16) & mask, addr))
+
+    ljd.rawdump.constants.read(state, prototype.constants)
+
+    if state.debuginfo_size != 0:
+        line_numbers = ljd.rawdump.debuginfo.read_line_numbers(state)
+        prototype.has_lines = True
+    else:
+        line_numbers = None
+
+    stream.skip_bytes(state.end_pos - stream.pos)
+
+    for index, addr in references:
+        prototype.addresses.setdefault(index, []).append(addr)
+
+        if line_numbers is not None:
+            line = first_line_number + line_numbers[addr - 1]
+            lines = prototype.lines.setdefault(index, [])
+
+            if line not in lines:
+                lines.append(line)
+
+
+def _collect_records(filename, prototype, path, records):
+    complex_constants = prototype.constants.complex_constants
+    children = 0
+
+    # The operands index the complex constants from the end. Walking them in
+    # operand order also goes through the child functions in source order.
+    for index, constant in enumerate(reversed(complex_constants)):
+        if isinstance(constant, _Prototype):
+            _collect_records(filename, constant, path + "/" + str(children), records)
+            children += 1
+            continue
+
+        if isinstance(constant, str):
+            constant_type = "string"
+            value = constant
+        elif isinstance(constant, ljd.bytecode.constants.Table):
+            constant_type = "table"
+            value = {
+                "array": constant.array,
+                "hash": constant.dictionary
+            }
+        else:
+            continue
+
+        record = dict.fromkeys(FIELDS)
+        record["file"] = filename
+        record["prototype"] = path
+        record["index"] = index
+        record["type"] = constant_type
+        record["value"] = value
+        record["addresses"] = prototype.addresses.get(index, [])
+
+        if prototype.has_lines:
+            record["lines"] = prototype.lines.get(index, [])
+
+        records.append(record)
@@ -21,7 +21,10 @@ class _State:
 def parse(filename, on_parse_header=None):
     parser = _State()
 
-    parser.stream.open(filename)
+    # Read as a whole, so the debug information can be left in the buffer
+    # until it is used
+    with open(filename, "rb") as fd:
+        parser.stream.open_bytes(fd.read(), filename)
 
     header = ljd.rawdump.header.Header()
 
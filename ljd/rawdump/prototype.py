@@ -25,6 +25,7 @@ class _State:
         self.numeric_constants_count = 0
         self.instructions_count = 0
         self.debuginfo_size = 0
+        self.end_pos = 0
 
 
 def read(parser, prototype):
@@ -41,6 +42,8 @@ def read(parser, prototype):
 
     start = parser.stream.pos
 
+    parser.end_pos = start + size
+
     r = True
 
     r = r and _read_flags(parser, prototype)
@@ -59,6 +62,48 @@ def read(parser, prototype):
     return r
 
 
+# Reads the flags, counts and sizes of a prototype and skips the rest of it.
+# Returns the reader state holding the counts, or None if there are no more
+# prototypes or they couldn't be read.
+def read_summary(parser, prototype):
+    parser = read_head(parser, prototype)
+
+    if parser is None:
+        return None
+
+    parser.stream.skip_bytes(parser.end_pos - parser.stream.pos)
+
+    return parser
+
+
+# Reads the flags, counts and sizes of a prototype, leaving the stream at
+# the instructions. Returns the reader state holding the counts and the
+# prototype's end position, or None as read_summary does.
+def read_head(parser, prototype):
+    parser = _State(parser)
+
+    size = parser.stream.read_uleb128()
+
+    if size == 0:
+        return None
+
+    if not parser.stream.check_data_available(size):
+        errprint("File truncated")
+        return None
+
+    parser.end_pos = parser.stream.pos + size
+
+    r = True
+
+    r = r and _read_flags(parser, prototype)
+    r = r and _read_counts_and_sizes(parser, prototype)
+
+    if not r:
+        return None
+
+    return parser
+
+
 def _read_flags(parser, prototype):
     bits = parser.stream.read_byte()
 
@@ -141,6 +186,6 @@ def _read_debuginfo(stream, prototype):
     if stream.debuginfo_size == 0:
         return True
 
-    return ljd.rawdump.debuginfo.read(stream,
-                                      prototype.first_line_number,
-                                      prototype.debuginfo)
+    return ljd.rawdump.debuginfo.read_lazily(stream,
+                                             prototype.first_line_number,
+                                             prototype.debuginfo)
@@ -0,0 +1,130 @@
+#
+# Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
+#
+
+import ljd.bytecode.prototype
+import ljd.rawdump.header
+import ljd.rawdump.prototype
+import ljd.util.binstream
+
+# Fields of the records returned by scan(), in output order
+FIELDS = (
+    "file",
+    "version",
+    "big_endian",
+    "stripped",
+    "fr2",
+    "ffi",
+    "name",
+    "prototypes",
+    "instructions",
+    "constants",
+    "first_line",
+    "last_line",
+    "error"
+)
+
+
+class _State:
+    def __init__(self):
+        self.stream = ljd.util.binstream.BinStream()
+        self.flags = ljd.rawdump.header.Flags()
+        self.header = None
+
+
+# Collects the metadata of a bytecode file from the file header and the
+# prototype headers only, skipping over the instructions, constants and
+# debug information.
+def scan(filename):
+    record = dict.fromkeys(FIELDS)
+    record["file"] = filename
+
+    parser = _State()
+
+    try:
+        parser.stream.open(filename)
+    except OSError as e:
+        record["error"] = str(e)
+        return record
+
+    try:
+        _scan_header(parser, record)
+
+        if record["error"] is None:
+            _scan_prototypes(parser, record)
+    except IOError as e:
+        record["error"] = str(e)
+    finally:
+        parser.stream.close()
+
+    return record
+
+
+# scan() for Main.write_records, which takes a list of records per file
+def scan_records(filename):
+    return [scan(filename)]
+
+
+def _scan_header(parser, record):
+    header = ljd.rawdump.header.Header()
+
+    if not ljd.rawdump.header.read(parser, header):
+        record["error"] = "Invalid header"
+        return
+
+    if header.flags.is_big_endian:
+        parser.stream.data_byteorder = 'big'
+    else:
+        parser.stream.data_byteorder = 'little'
+
+    parser.header = header
+
+    record["version"] = header.version
+    record["big_endian"] = header.flags.is_big_endian
+    record["stripped"] = header.flags.is_stripped
+    record["fr2"] = header.flags.fr2
+    record["ffi"] = header.flags.has_ffi
+
+    if not header.flags.is_stripped:
+        record["name"] = header.name
+
+
+def _scan_prototypes(parser, record):
+    prototypes = 0
+    instructions = 0
+    constants = 0
+    first_line = None
+    last_line = None
+
+    while not parser.stream.eof():
+        prototype = ljd.bytecode.prototype.Prototype()
+
+        counts = ljd.rawdump.prototype.read_summary(parser, prototype)
+
+        if counts is None:
+            if not parser.stream.eof():
+                record["error"] = "Failed to read prototype"
+
+            break
+
+        prototypes += 1
+        instructions += counts.instructions_count
+        constants += counts.complex_constants_count + counts.numeric_constants_count
+
+        if prototype.flags.has_ffi:
+            record["ffi"] = True
+
+        if counts.debuginfo_size != 0:
+            prototype_last_line = prototype.first_line_number + prototype.lines_count
+
+            if first_line is None or prototype.first_line_number < first_line:
+                first_line = prototype.first_line_number
+
+            if last_line is None or prototype_last_line > last_line:
+                last_line = prototype_last_line
+
+    record["prototypes"] = prototypes
+    record["instructions"] = instructions
+    record["constants"] = constants
+    record["first_line"] = first_line
+    record["last_line"] = last_line
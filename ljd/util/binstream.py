@@ -2,14 +2,19 @@
 # Copyright (C) 2013 Andrian Nord. See Copyright Notice in main.py
 #
 
+import array
 import io
 import os
 import sys
 
+# array typecodes for unsigned integers by their size in bytes
+_UINT_TYPECODES = {array.array(typecode).itemsize: typecode for typecode in "LIHB"}
+
 
 class BinStream:
     def __init__(self):
         self.fd = None
+        self.buffer = None
 
         self.size = 0
         self.pos = 0
@@ -22,8 +27,16 @@ class BinStream:
         self.fd = io.open(filename, 'rb')
         self.size = os.stat(filename).st_size
 
+    def open_bytes(self, data, name=""):
+        self.name = name
+        self.fd = io.BytesIO(data)
+        self.buffer = memoryview(data)
+        self.size = len(data)
+        self.pos = 0
+
     def close(self):
         self.fd.close()
+        self.buffer = None
         self.size = 0
         self.pos = 0
 
@@ -43,6 +56,28 @@ class BinStream:
 
         return data
 
+    def skip_bytes(self, size):
+        if not self.check_data_available(size):
+            raise IOError("Unexpected EOF while trying to skip {0} bytes"
+                          .format(size))
+
+        self.fd.seek(size, io.SEEK_CUR)
+        self.pos += size
+
+    # Skips over the next size bytes and returns a view of them, sharing the
+    # buffer instead of copying it. Only for streams opened with open_bytes.
+    def skip_bytes_view(self, size):
+        if not self.check_data_available(size):
+            raise IOError("Unexpected EOF while trying to skip {0} bytes"
+                          .format(size))
+
+        view = self.buffer[self.pos:self.pos + size]
+
+        self.fd.seek(size, io.SEEK_CUR)
+        self.pos += size
+
+        return view
+
     def read_byte(self):
         if not self.check_data_available(1):
             raise IOError("Unexpected EOF while trying to read 1 byte")
@@ -135,6 +170,32 @@ class BinStream:
 
         return string
 
+    # Decodes a buffer holding nothing but ULEB128 values. The 33 bit values
+    # of read_uleb128_from33bit are just ULEB128 values with the flag in the
+    # lowest bit, so this works for those as well.
+    @staticmethod
+    def decode_uleb128_values(data):
+        values = []
+
+        value = 0
+        bitshift = 0
+
+        for byte in data:
+            value |= (byte & 0x7f) << bitshift
+
+            if byte < 0x80:
+                values.append(value)
+
+                value = 0
+                bitshift = 0
+            else:
+                bitshift += 7
+
+        if bitshift != 0:
+            raise IOError("Unexpected end of ULEB128 value")
+
+        return values
+
     def read_uleb128_from33bit(self):
         first_byte = self.read_byte()
 
@@ -161,3 +222,11 @@ class BinStream:
 
         return int.from_bytes(value, byteorder=self.data_byteorder,
                               signed=False)
+
+    def read_uint_array(self, count, size=4):
+        values = array.array(_UINT_TYPECODES[size], self.read_bytes(count * size))
+
+        if self.data_byteorder != sys.byteorder:
+            values.byteswap()
+
+        return values
@@ -23,16 +23,24 @@
 # SOFTWARE.
 #
 
+import copy
+import csv
+import json
 import logging
 import os
 import sys
 import struct
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from optparse import OptionParser, OptionGroup
 from shutil import copyfile
 
 import ljd.rawdump.parser
 import ljd.rawdump.code
+import ljd.rawdump.scan
+import ljd.rawdump.extract
 import ljd.pseudoasm.writer
 import ljd.pseudoasm.instructions
 import ljd.ast.builder
@@ -42,6 +50,7 @@ import ljd.ast.locals
 import ljd.ast.unwarper
 import ljd.ast.mutator
 import ljd.ast.printast
+import ljd.ast.snapshot
 import ljd.lua.writer
 
 import ljd.ast.nodes as nodes
@@ -68,10 +77,20 @@ def set_luajit_version(bc_version):
         raise Exception("Unknown LuaJIT opcode module name for version " + str(bc_version))
 
     ljd.rawdump.code.init(opcodes)
-    ljd.ast.builder.init()
+    ljd.ast.builder.init(opcodes)
     ljd.pseudoasm.instructions.init()
 
 
+# The options each rung of the --retry ladder sets, on top of those of the rungs
+# before it (and of the command line)
+RETRY_RUNGS = {
+    "rollback": {"rollback": True},
+    "catch": {"catch_asserts": True},
+    "safe": {"unsafe_extra_pass": False},
+    "goto": {"goto_output": True},
+}
+
+
 class Main:
     def __init__(self):
         # Parser arguments
@@ -107,6 +126,21 @@ class Main:
                           type="string", dest="lua_src_ext", default="",
                           help="use source files", metavar="EXT")
 
+        # Only read the headers of the input files and write out their metadata instead of decompiling them
+        parser.add_option("--scan",
+                          type="choice", dest="scan_format", default=None, choices=["jsonl", "csv"],
+                          help="write the metadata of the input files as jsonl or csv", metavar="FORMAT")
+
+        # Only extract the string and table constants of the input files, with the lines referencing them
+        parser.add_option("--constants",
+                          type="choice", dest="constants_format", default=None, choices=["jsonl", "csv"],
+                          help="write the string and table constants of the input files as jsonl or csv",
+                          metavar="FORMAT")
+
+        parser.add_option("-j", "--jobs",
+                          type="int", dest="jobs", default=os.cpu_count() or 1,
+                          help="number of processes to use with --scan and --constants", metavar="N")
+
         # Prevent most integrity asserts from canceling decompilation
         parser.add_option("-c", "--catch_asserts",
                           action="store_true", dest="catch_asserts", default=False,
@@ -128,6 +162,35 @@ class Main:
         parser.add_option("--unsafe", type="string", dest="unsafe_extra_pass", default="true",
                           help="unsafe extra pass to try to correct some leftover values")
 
+        # Skip the unwarper and write the control flow as labels and gotos. Ugly, but fast and it always works.
+        parser.add_option("--goto",
+                          action="store_true", dest="goto_output", default=False,
+                          help="write the control flow with goto instead of recovering loops and ifs")
+
+        # Bound the time spent on pathological files: the functions still being unwarped when a budget runs out are
+        # written with goto instead, as with --goto
+        parser.add_option("--time-budget",
+                          type="float", dest="time_budget", default=None,
+                          help="seconds a file may take before its remaining functions are written with goto",
+                          metavar="SECONDS")
+
+        parser.add_option("--function-time-budget",
+                          type="float", dest="function_time_budget", default=None,
+                          help="seconds the unwarper may spend on a function before writing it with goto",
+                          metavar="SECONDS")
+
+        # Put the functions the unwarper fails on back the way they were and write them with goto, instead of
+        # failing the whole file or leaving them half unwarped with -c
+        parser.add_option("--rollback",
+                          action="store_true", dest="rollback", default=False,
+                          help="write the functions that fail to unwarp with goto instead of giving up on the file")
+
+        # Decompile the files that fail in a batch again, with more and more tolerant options, see RETRY_RUNGS
+        parser.add_option("--retry",
+                          type="string", dest="retry_ladder", default="",
+                          help="comma separated options to retry failed files with, in order, out of "
+                               + ", ".join(RETRY_RUNGS), metavar="RUNGS")
+
         group = OptionGroup(parser, "Debug Options")
 
         # Output a log of exceptions and information during decompilation
@@ -181,23 +244,17 @@ class Main:
                     parser.error("Output folder is a file.")
                     sys.exit(0)
 
-        # TODO merge into the module handling below
-        if self.options.catch_asserts:
-            ljd.ast.builder.handle_invalid_functions = True
-
-        for mod in [ljd.ast.unwarper, ljd.ast.slotworks, ljd.ast.validator]:
-            if self.options.dump_ast:
-                mod.debug_dump = True
-            if self.options.catch_asserts:
-                mod.catch_asserts = True
-            if self.options.verbose:
-                mod.verbose = True
+        self.retry_ladder = [name.strip() for name in self.options.retry_ladder.split(",") if name.strip()]
 
-        if self.options.include_line_numbers:
-            ljd.lua.writer.show_line_info = True
+        for name in self.retry_ladder:
+            if name not in RETRY_RUNGS:
+                parser.error("Unknown retry rung: {0}".format(name))
+                sys.exit(1)
 
         self.options.unsafe_extra_pass = self.options.unsafe_extra_pass.lower() in ['true', '1', 't', 'y', 'yes']
 
+        self.configure_modules()
+
         # Start logging if required
         if self.options.enable_logging:
             logger = logging.getLogger('LJD')
@@ -219,67 +276,118 @@ class Main:
 
         self.logger = logger
 
+    # Hands the options over to the modules that read them as globals. Called again whenever the options change.
+    def configure_modules(self):
+        ljd.ast.builder.handle_invalid_functions = self.options.catch_asserts
+
+        for mod in [ljd.ast.unwarper, ljd.ast.slotworks, ljd.ast.validator]:
+            if self.options.dump_ast:
+                mod.debug_dump = True
+            mod.catch_asserts = self.options.catch_asserts
+            if self.options.verbose:
+                mod.verbose = True
+
+        if self.options.include_line_numbers:
+            ljd.lua.writer.show_line_info = True
+
+        ljd.lua.writer.goto_output = self.options.goto_output
+
+        ljd.ast.unwarper.function_time_budget = self.options.function_time_budget
+        ljd.ast.unwarper.rollback_failures = self.options.rollback
+
     def main(self):
-        # Recursive batch processing
         if self.options.folder_name:
             self.options.folder_name = os.path.sep.join(os.path.normpath(self.options.folder_name).split('\\'))
-            for path, _, file_names in os.walk(self.options.folder_name):
-                for file in file_names:
-                    # Skip files we're not interested in based on the extension
-                    if not file.endswith(self.options.lua_ext):
-                        continue
 
-                    full_path = os.path.join(path, file)
+        if self.options.scan_format:
+            return self.write_records(ljd.rawdump.scan.scan_records, ljd.rawdump.scan.FIELDS,
+                                      self.options.scan_format)
 
-                    # Copy raw source files?
+        if self.options.constants_format:
+            return self.write_records(ljd.rawdump.extract.extract, ljd.rawdump.extract.FIELDS,
+                                      self.options.constants_format)
+
+        # Recursive batch processing
+        if self.options.folder_name:
+            # How many of the failed files each rung of the retry ladder got through, and how many none did
+            retried = Counter()
+            still_failed = 0
+
+            for path, file, full_path in self.find_files():
+                # Copy raw source files?
+                if self.options.enable_logging:
+                    self.logger.info(full_path)
+                try:
+                    if self.options.lua_src_ext:
+                        src_file = os.path.splitext(file)[0] + "." + self.options.lua_src_ext
+                        full_src_path = os.path.join(path, src_file)
+                        if os.path.exists(full_src_path) and os.path.getsize(full_src_path) > 0:
+                            if self.options.enable_logging:
+                                self.logger.info("Skipping {0}: Source file available.".format(full_path))
+
+                            new_path = os.path.join(self.options.output,
+                                                    os.path.relpath(full_path, self.options.folder_name))
+                            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                            if not file.endswith('.lua'):
+                                new_path = new_path[:-1]
+                            copyfile(full_src_path, new_path)
+                            if self.options.enable_logging:
+                                self.logger.info("Success")
+                            continue
+                except (KeyboardInterrupt, SystemExit):
+                    print("Interrupted")
+                    sys.stdout.flush()
                     if self.options.enable_logging:
-                        self.logger.info(full_path)
-                    try:
-                        if self.options.lua_src_ext:
-                            src_file = os.path.splitext(file)[0] + "." + self.options.lua_src_ext
-                            full_src_path = os.path.join(path, src_file)
-                            if os.path.exists(full_src_path) and os.path.getsize(full_src_path) > 0:
-                                if self.options.enable_logging:
-                                    self.logger.info("Skipping {0}: Source file available.".format(full_path))
-
-                                new_path = os.path.join(self.options.output,
-                                                        os.path.relpath(full_path, self.options.folder_name))
-                                os.makedirs(os.path.dirname(new_path), exist_ok=True)
-                                if not file.endswith('.lua'):
-                                    new_path = new_path[:-1]
-                                copyfile(full_src_path, new_path)
-                                if self.options.enable_logging:
-                                    self.logger.info("Success")
-                                continue
-                    except (KeyboardInterrupt, SystemExit):
-                        print("Interrupted")
-                        sys.stdout.flush()
-                        if self.options.enable_logging:
-                            self.logger.info("Exit")
-                        return 0
-                    except OSError as exc:
-                        print("\n--; Exception in %s" % full_path)
-                        print("-- %s" % exc)
-                        if self.options.enable_logging:
-                            self.logger.info("OS Exception")
-                            self.logger.debug('', exc_info=True)
-                        continue
+                        self.logger.info("Exit")
+                    return 0
+                except OSError as exc:
+                    print("\n--; Exception in %s" % full_path)
+                    print("-- %s" % exc)
+                    if self.options.enable_logging:
+                        self.logger.info("OS Exception")
+                        self.logger.debug('', exc_info=True)
+                    continue
 
-                    # Process current file
+                # Process current file
+                try:
                     try:
                         self.process_file(file, full_path, self.logger)
-                    except (KeyboardInterrupt, SystemExit):
-                        print("Interrupted")
-                        sys.stdout.flush()
-                        if self.options.enable_logging:
-                            self.logger.info("Exit")
-                        return 0
                     except Exception as exc:
-                        print("\n--; Exception in {0}".format(full_path))
+                        if not self.retry_ladder:
+                            raise
+
+                        print("\n--; Exception in {0}, retrying".format(full_path))
                         print(exc)
                         if self.options.enable_logging:
-                            self.logger.info("Exception")
+                            self.logger.info("Exception, retrying")
                             self.logger.debug('', exc_info=True)
+
+                        try:
+                            rung = self.retry_file(file, full_path, self.logger, exc)
+                        except Exception:
+                            still_failed += 1
+                            raise
+
+                        retried[rung] += 1
+
+                        print("--; Decompiled {0} with --retry {1}".format(full_path, rung))
+                        if self.options.enable_logging:
+                            self.logger.info("Success with --retry {0}".format(rung))
+                except (KeyboardInterrupt, SystemExit):
+                    print("Interrupted")
+                    sys.stdout.flush()
+                    if self.options.enable_logging:
+                        self.logger.info("Exit")
+                    return 0
+                except Exception as exc:
+                    print("\n--; Exception in {0}".format(full_path))
+                    print(exc)
+                    if self.options.enable_logging:
+                        self.logger.info("Exception")
+                        self.logger.debug('', exc_info=True)
+
+            if retried or still_failed:
+                self.report_retries(retried, still_failed)
             return 0
 
         # Single file processing
@@ -309,14 +417,66 @@ class Main:
 
         return 0
 
-    def process_file(self, file, full_path, logger):
+    # Walks the input folder, yielding the (folder, file name, path) of the files to process
+    def find_files(self):
+        for path, _, file_names in os.walk(self.options.folder_name):
+            for file in file_names:
+                # Skip files we're not interested in based on the extension
+                if not file.endswith(self.options.lua_ext):
+                    continue
+
+                yield path, file, os.path.join(path, file)
+
+    # Writes the records of each input file, read_records returns the list of records of a file
+    def write_records(self, read_records, fields, output_format):
+        if self.options.folder_name:
+            file_names = (full_path for _, _, full_path in self.find_files())
+        else:
+            file_names = [self.options.file_name]
+
+        if self.options.output:
+            out_file = open(self.options.output, "w", encoding="utf8", newline="")
+        else:
+            out_file = sys.stdout
+
         try:
-            ast = self.decompile(full_path)
+            if output_format == "csv":
+                csv_writer = csv.DictWriter(out_file, fields)
+                csv_writer.writeheader()
+
+                def write_record(record):
+                    # Nested values (lists, tables) are written as JSON
+                    csv_writer.writerow({key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                                         for key, value in record.items()})
+            else:
+                def write_record(record):
+                    out_file.write(json.dumps(record) + "\n")
+
+            if self.options.jobs > 1:
+                with ProcessPoolExecutor(self.options.jobs) as executor:
+                    for records in executor.map(read_records, file_names, chunksize=64):
+                        for record in records:
+                            write_record(record)
+            else:
+                for file_name in file_names:
+                    for record in read_records(file_name):
+                        write_record(record)
+        except KeyboardInterrupt:
+            print("Interrupted", file=sys.stderr)
+        finally:
+            if out_file is not sys.stdout:
+                out_file.close()
+
+        return 0
+
+    def process_file(self, file, full_path, logger, ast=None):
+        try:
+            if ast is None:
+                ast = self.decompile(full_path)
 
             if not self.options.output:
                 print("\n--; Decompile of {0}".format(full_path))
                 ljd.lua.writer.write(sys.stdout, ast)
-                self.lock.release()
                 return 0
 
             new_path = os.path.join(self.options.output, os.path.relpath(full_path, self.options.folder_name))
@@ -333,13 +493,124 @@ class Main:
             raise
         return 1
 
+    # Decompiles a failed file again, adding the options of each rung of the retry ladder in turn. Returns the name
+    # of the rung that got through, or raises the error of the last one.
+    def retry_file(self, file, full_path, logger, error):
+        original_options = self.options
+
+        ladder = []
+        options = original_options
+
+        for name in self.retry_ladder:
+            options = copy.copy(options)
+            for key, value in RETRY_RUNGS[name].items():
+                setattr(options, key, value)
+            ladder.append((name, options))
+
+        # The builder fixes up the instructions of the prototype in place, so every build starts from a new parse.
+        # The built AST only depends on -c though, so the rungs after the first one to build it start from a copy.
+        snapshots = {}
+
+        try:
+            for i, (name, options) in enumerate(ladder):
+                self.options = options
+                self.configure_modules()
+
+                deadline = self.get_deadline()
+
+                snapshot = snapshots.get(options.catch_asserts)
+
+                # No option helps with a file that can't be read, so that isn't retried
+                if snapshot is None:
+                    header, prototype = self.parse(full_path)
+
+                    if not prototype:
+                        raise error
+
+                try:
+                    if snapshot is not None:
+                        ast = ljd.ast.snapshot.restore(snapshot)
+                    else:
+                        ast = self.build(header, prototype)
+
+                        if any(later.catch_asserts == options.catch_asserts for _, later in ladder[i + 1:]):
+                            snapshot = ljd.ast.snapshot.take_function(ast)
+                            if snapshot is not None:
+                                snapshots[options.catch_asserts] = snapshot
+
+                    ast = self.process_ast(full_path, ast, deadline)
+                    self.process_file(file, full_path, logger, ast)
+                    return name
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception as exc:
+                    error = exc
+                    if self.options.enable_logging:
+                        logger.info("Exception with --retry {0}".format(name))
+                        logger.debug('', exc_info=True)
+
+            raise error
+        finally:
+            self.options = original_options
+            self.configure_modules()
+
+    def report_retries(self, retried, still_failed):
+        rungs = ", ".join("{0}: {1}".format(name, retried[name]) for name in self.retry_ladder if retried[name])
+        message = "Retried {0} files ({1}), {2} still failed".format(sum(retried.values()) + still_failed,
+                                                                      rungs or "none decompiled", still_failed)
+
+        print("\n--; {0}".format(message))
+
+        if self.options.enable_logging:
+            self.logger.info(message)
+
     def write_file(self, ast, file_name, **kwargs):
         if self.options.enable_logging:
             self.logger.debug("Writing file {0}...".format(file_name))
         with open(file_name, "w", encoding="utf8") as out_file:
             return ljd.lua.writer.write(out_file, ast, **kwargs)
 
+    def report_degraded(self, file_in, function, reason):
+        line_info = getattr(function, "_lineinfo", None)
+
+        if line_info:
+            where = "function at line {0}".format(line_info[0])
+        else:
+            where = "function of {0} instructions".format(function._instructions_count)
+
+        self.report_warning("{0}: {1}, {2} written with goto".format(file_in, reason, where))
+
+    def report_warning(self, message):
+        print("-- Decompilation Warning: {0}\n".format(message), file=sys.stdout)
+
+        if self.options.enable_logging:
+            self.logger.info(message)
+
+    def get_deadline(self):
+        if self.options.time_budget is not None:
+            return time.monotonic() + self.options.time_budget
+        return None
+
     def decompile(self, file_in):
+        deadline = self.get_deadline()
+
+        header, prototype = self.parse(file_in)
+
+        if not prototype:
+            return 1
+
+        if self.options.output_pseudoasm:
+            ljd.pseudoasm.writer.write(sys.stdout, header, prototype)
+
+        ast = self.build(header, prototype)
+
+        if self.options.dump_ast:
+            ljd.ast.printast.dump("AST [locals]", ast)
+            return
+
+        return self.process_ast(file_in, ast, deadline)
+
+    def parse(self, file_in):
         def on_parse_header(preheader):
             # Identify the version of LuaJIT used to compile the file
             bc_version = None
@@ -352,14 +623,10 @@ class Main:
 
             set_luajit_version(bc_version)
 
-        header, prototype = ljd.rawdump.parser.parse(file_in, on_parse_header)
-
-        if not prototype:
-            return 1
-
-        if self.options.output_pseudoasm:
-            ljd.pseudoasm.writer.write(sys.stdout, header, prototype)
+        return ljd.rawdump.parser.parse(file_in, on_parse_header)
 
+    # The first steps, which don't depend on the options (other than -c)
+    def build(self, header, prototype):
         ast = ljd.ast.builder.build(header, prototype)
 
         assert ast is not None
@@ -368,14 +635,11 @@ class Main:
 
         ljd.ast.mutator.pre_pass(ast)
 
-        ljd.ast.validator.validate(ast, warped=True)
-
-        ljd.ast.locals.mark_locals(ast)
+        ljd.ast.locals.mark_locals(ast, fused=[ljd.ast.validator.Visitor(warped=True)])
 
-        if self.options.dump_ast:
-            ljd.ast.printast.dump("AST [locals]", ast)
-            return
+        return ast
 
+    def process_ast(self, file_in, ast, deadline):
         try:
             ljd.ast.slotworks.eliminate_temporary(ast, identify_slots=True)
         except AssertionError:
@@ -386,8 +650,10 @@ class Main:
 
         # ljd.ast.validator.validate(ast, warped=True)
 
-        if not self.options.no_unwarp:
-            ljd.ast.unwarper.unwarp(ast, False)
+        degraded = {}
+
+        if not self.options.no_unwarp and not self.options.goto_output:
+            degraded = ljd.ast.unwarper.unwarp(ast, False, deadline)
 
             # ljd.ast.validator.validate(ast, warped=False)
 
@@ -446,6 +712,27 @@ class Main:
                                     for i, subnode in enumerate(reversed(content_list)):
                                         if getattr(subnode, "_invalidated", False):
                                             del content_list[j - i]
+        elif self.options.goto_output:
+            # Still needed to fold the table element assignments into their constructors
+            ljd.ast.mutator.primary_pass(ast)
+
+        # The functions the unwarper gave up on get their warped body back, to be written with goto
+        for function, (statements, reason) in degraded.items():
+            function.statements = statements
+            ljd.ast.mutator.primary_pass(function)
+
+            self.report_degraded(file_in, function, reason)
+
+        if degraded:
+            setattr(ast, "_warped_functions", list(degraded))
+
+        ljd.ast.mutator.output_pass(ast)
+
+        if self.options.goto_output or degraded:
+            shared = ljd.lua.writer.find_shared_captures(ast)
+
+            for function in shared:
+                self.report_degraded(file_in, function, "closures might share the locals they capture")
 
         return ast
 
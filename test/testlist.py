@@ -9,6 +9,15 @@ tests = [
     Test("illegal_type_eliminations", Mode.MATCHES),
     Test("slot_local_declarations", Mode.MATCHES),
     Test("slot_block_gathering", Mode.MATCHES),
+    Test("repeat_until_true", Mode.MATCHES),
+    # The and/or assignment comes back as an if statement, so the bytecode can't match
+    Test("repeat_until_true_expression", Mode.DECOMPILES),
+    # Same here, and the comparison after it compiles the same when it's wrongly inverted
+    Test("unary_expression_comparison", Mode.DECOMPILES),
+
+    # The goto output can't match the bytecode, but the closures created in loops must still get their own locals
+    Test("goto_closures", Mode.RUNS, ["--goto"]),
+    Test("time_budget_closures", Mode.RUNS, ["--function-time-budget", "0"]),
 
     # The old (pre test framework) tests
     Test("old/breaks", Mode.MATCHES),
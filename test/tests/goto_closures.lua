@@ -0,0 +1,71 @@
+local fs = {}
+
+for i = 1, 3 do
+	fs[#fs + 1] = function()
+		return i
+	end
+end
+
+for _, v in ipairs({ 4, 5 }) do
+	fs[#fs + 1] = function()
+		return v
+	end
+end
+
+local n = 5
+
+while n < 8 do
+	local x = n * 2
+
+	n = n + 1
+
+	fs[#fs + 1] = function()
+		return x
+	end
+end
+
+for i = 1, 4 do
+	if i % 2 == 0 then
+		goto continue
+	end
+
+	do
+		local y = i + 20
+
+		fs[#fs + 1] = function()
+			return y
+		end
+	end
+
+	::continue::
+end
+
+local function collect(t, stop)
+	local gs = {}
+
+	for i, v in ipairs(t) do
+		gs[#gs + 1] = function()
+			return i .. v
+		end
+
+		if v == stop then
+			return gs
+		end
+	end
+
+	return gs
+end
+
+local gs = collect({ "a", "b", "c" }, "b")
+
+for _, g in ipairs(collect({ "d" })) do
+	gs[#gs + 1] = g
+end
+
+for _, g in ipairs(gs) do
+	fs[#fs + 1] = g
+end
+
+for _, f in ipairs(fs) do
+	print(f())
+end
@@ -0,0 +1,8 @@
+for i = 1, 10 do
+	repeat
+		if f(i) then
+			break
+		end
+		g(i)
+	until true
+end
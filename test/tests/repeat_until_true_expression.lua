@@ -0,0 +1,13 @@
+local x, y = ...
+
+for i = 1, 10 do
+	x = x < y and x + 1 or x
+
+	repeat
+		if f(i) then
+			break
+		end
+
+		g(i)
+	until true
+end
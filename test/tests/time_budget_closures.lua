@@ -0,0 +1,39 @@
+local function counters(n)
+	local fs = {}
+
+	for i = 1, n do
+		local count = i * 10
+
+		fs[i] = function()
+			count = count + 1
+
+			return count
+		end
+	end
+
+	return fs
+end
+
+local fs = counters(3)
+local gs = counters(1)
+
+print(fs[1](), fs[2](), fs[1](), fs[3](), gs[1]())
+
+local function each(t, f)
+	for k, v in pairs(t) do
+		f(function()
+			return k .. "=" .. v
+		end)
+	end
+end
+
+local names = {}
+
+local function add(g)
+	names[#names + 1] = g
+end
+
+each({ a = 1 }, add)
+each({ b = 2 }, add)
+
+print(names[1](), names[2]())
@@ -0,0 +1,9 @@
+local a, b = ...
+
+a = a < b and a + 1 or a
+
+if a < b then
+	print(1)
+end
+
+print(a)
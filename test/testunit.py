@@ -20,6 +20,10 @@ class Mode(Enum):
     MATCHES = 3
     """The file decompiles, and it's re-compiled output matches the original bytecode"""
 
+    RUNS = 4
+    """The file decompiles, and its output prints the same as the original when run - for the options (like --goto)
+    whose output can't match the original bytecode"""
+
 
 class TestResult(Enum):
     PASS = 1
@@ -28,9 +32,10 @@ class TestResult(Enum):
 
 
 class Test:
-    def __init__(self, name, level):
+    def __init__(self, name, level, options=()):
         self.name = name
         self.level = level
+        self.options = list(options)
         self.src = Path(test_dir, "%s.lua" % name)
 
         self.bc_out = None
@@ -55,8 +60,14 @@ class Test:
         self.compile(config, False, tmpdir)
         self.decompile(config)
 
+        if self.level == Mode.RUNS:
+            if lj_run(config, self.src) != lj_run(config, self.src_out):
+                return TestResult.FAIL
+
+            return TestResult.PASS
+
         if self.level != Mode.MATCHES:
-            return
+            return TestResult.PASS
 
         self.recompile(config)
 
@@ -81,7 +92,7 @@ class Test:
     def decompile(self, config):
         assert self.bc_out
         config.log("Decompiling " + self.name)
-        lj_decompile(config, self.bc_out, self.src_out)
+        lj_decompile(config, self.bc_out, self.src_out, self.options)
 
     def recompile(self, config):
         assert self.bc_out
@@ -101,12 +112,17 @@ def lj_compile(config, input, output, symbols):
     cfg_run(config, args)
 
 
-def lj_decompile(config, input, output):
+def lj_decompile(config, input, output, options):
     main_file = Path(sys.argv[0]).resolve().parent / "main.py"
-    args = ["python3", str(main_file), "-f", str(input), "-o", str(output)]
+    args = ["python3", str(main_file), "-f", str(input), "-o", str(output)] + options
     cfg_run(config, args)
 
 
+def lj_run(config, input):
+    config.log("Running " + str(input))
+    return subprocess.run(["luajit", str(input.resolve())], check=True, stdout=subprocess.PIPE).stdout
+
+
 def cfg_run(config, args):
     kwargs = {
         "args": args,